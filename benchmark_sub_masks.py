@@ -0,0 +1,71 @@
+# Benchmark for the vectorized create_sub_masks against the original per pixel loop.
+# It checks that both give the same masks (same keys, same order, same pixels) and prints the timings.
+#
+# python3 benchmark_sub_masks.py                          -> synthetic 1920x1080 instance_seg frame
+# python3 benchmark_sub_masks.py --image path/to/0.png    -> a real instance_seg frame
+
+import argparse
+import time
+import numpy as np
+from PIL import Image
+
+from vis_data_annotation import create_sub_masks, create_sub_masks_pixelwise
+
+def make_synthetic_frame(width, height, num_instances, seed):
+    # Paint some random rectangles with actor classes (12-19 in R) and random instance ids (G, B) on top of a background
+    rng = np.random.default_rng(seed)
+    frame = np.zeros((height, width, 4), dtype=np.uint8)
+    frame[:, :, 0] = rng.integers(0, 12, size=(height, width)) # non actor classes
+    frame[:, :, 3] = 255
+
+    for _ in range(num_instances):
+        x0 = rng.integers(0, width - 1)
+        y0 = rng.integers(0, height - 1)
+        x1 = min(width, x0 + rng.integers(5, width // 6))
+        y1 = min(height, y0 + rng.integers(5, height // 6))
+        frame[y0:y1, x0:x1, 0] = rng.integers(12, 20)
+        frame[y0:y1, x0:x1, 1] = rng.integers(0, 256)
+        frame[y0:y1, x0:x1, 2] = rng.integers(0, 256)
+
+    return Image.fromarray(frame, 'RGBA')
+
+def check_same(fast, slow):
+    assert list(fast.keys()) == list(slow.keys()), "instances differ (or are in a different order)"
+    for k in slow:
+        assert np.array_equal(fast[k], np.array(slow[k])), f"mask for {k} differs"
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark create_sub_masks')
+    parser.add_argument('--image', type=str, default=None, help='instance_seg png to use instead of a synthetic frame')
+    parser.add_argument('--width', type=int, default=1920, help='Width of the synthetic frame')
+    parser.add_argument('--height', type=int, default=1080, help='Height of the synthetic frame')
+    parser.add_argument('--instances', type=int, default=30, help='Number of instances in the synthetic frame')
+    parser.add_argument('--repeats', type=int, default=5, help='Number of times to run the vectorized version')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the synthetic frame')
+    args = parser.parse_args()
+
+    if args.image:
+        img = Image.open(args.image)
+    else:
+        img = make_synthetic_frame(args.width, args.height, args.instances, args.seed)
+
+    start = time.perf_counter()
+    slow = create_sub_masks_pixelwise(img, img.width, img.height)
+    slow_time = time.perf_counter() - start
+
+    fast_times = []
+    for _ in range(args.repeats):
+        start = time.perf_counter()
+        fast = create_sub_masks(img, img.width, img.height)
+        fast_times.append(time.perf_counter() - start)
+    fast_time = min(fast_times)
+
+    check_same(fast, slow)
+
+    print(f"{img.width}x{img.height}, {len(slow)} instances")
+    print(f"pixelwise:  {slow_time * 1000:.1f} ms")
+    print(f"vectorized: {fast_time * 1000:.1f} ms (best of {args.repeats})")
+    print(f"speedup:    {slow_time / fast_time:.1f}x")
+
+if __name__ == '__main__':
+    main()
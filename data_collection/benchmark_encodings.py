@@ -0,0 +1,94 @@
+# Benchmark for the frame encodings in frame_encoding.py. For every camera and every encoding that makes sense for it,
+# this reports how big a frame ends up on disk (MB/frame) and how long it takes to encode (ms/frame), so we can pick
+# the trade-off that suits the disk-bound machines.
+#
+# python3 benchmark_encodings.py        -> synthetic 1920x1080 frames
+# python3 benchmark_encodings.py --rgb /Data/.../rgb/0.png --rgb_seg /Data/.../rgb_seg/0.png --instance_seg /Data/.../instance_seg/0.png
+#                                       -> real frames saved by data_collection.py
+
+import argparse
+import time
+import numpy as np
+import cv2
+
+from frame_encoding import CAMERA_ENCODINGS, encode_frame
+
+PNG_LEVELS = [1, 3, 6, 9]
+
+# The synthetic frames are only a rough stand in for the real ones: a smooth noisy gradient for rgb and blocks of
+# classes/instances for the segmentation cameras. Use real frames for numbers you want to rely on.
+def make_synthetic_frames(width, height, seed):
+    rng = np.random.default_rng(seed)
+
+    rgb = np.zeros((height, width, 4), dtype=np.uint8)
+    gradient = np.linspace(0, 200, width, dtype=np.float32)[None, :] + np.linspace(0, 55, height, dtype=np.float32)[:, None]
+    for c in range(3):
+        rgb[:, :, c] = np.clip(gradient + rng.normal(0, 8, size=(height, width)), 0, 255).astype(np.uint8)
+    rgb[:, :, 3] = 255
+
+    seg = np.zeros((height, width, 4), dtype=np.uint8)
+    seg[:, :, 3] = 255
+    block = 60
+    classes = rng.integers(0, 23, size=(height // block + 1, width // block + 1), dtype=np.uint8)
+    seg[:, :, 2] = np.kron(classes, np.ones((block, block), dtype=np.uint8))[:height, :width]
+
+    instance = seg.copy()
+    instance_ids = rng.integers(0, 2**16, size=classes.shape, dtype=np.uint32)
+    instance_ids = np.kron(instance_ids, np.ones((block, block), dtype=np.uint32))[:height, :width]
+    instance[:, :, 1] = (instance_ids >> 8).astype(np.uint8)
+    instance[:, :, 0] = (instance_ids & 255).astype(np.uint8)
+
+    return {
+        'sensor.camera.rgb': rgb,
+        'sensor.camera.semantic_segmentation': seg,
+        'sensor.camera.instance_segmentation': instance,
+    }
+
+def load_frame(path):
+    frame = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if frame is None:
+        raise IOError(f'Could not read {path}')
+    if frame.ndim == 3 and frame.shape[2] == 3:
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2BGRA)
+    return frame
+
+def benchmark(frame, encoding, png_compression, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        data = encode_frame(frame, encoding, png_compression)
+        times.append(time.perf_counter() - start)
+    return len(data) / 2**20, 1000 * float(np.median(times))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark frame encodings')
+    parser.add_argument('--rgb', type=str, default=None, help='rgb png to use instead of a synthetic frame')
+    parser.add_argument('--rgb_seg', type=str, default=None, help='rgb_seg png to use instead of a synthetic frame')
+    parser.add_argument('--instance_seg', type=str, default=None, help='instance_seg png to use instead of a synthetic frame')
+    parser.add_argument('--width', type=int, default=1920, help='Width of the synthetic frames')
+    parser.add_argument('--height', type=int, default=1080, help='Height of the synthetic frames')
+    parser.add_argument('--repeats', type=int, default=5, help='Number of times to encode each frame')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the synthetic frames')
+    args = parser.parse_args()
+
+    frames = make_synthetic_frames(args.width, args.height, args.seed)
+    for blueprint, path in [('sensor.camera.rgb', args.rgb), ('sensor.camera.semantic_segmentation', args.rgb_seg),
+                            ('sensor.camera.instance_segmentation', args.instance_seg)]:
+        if path:
+            frames[blueprint] = load_frame(path)
+
+    print(f"{'camera':<38}{'encoding':<24}{'MB/frame':>10}{'ms/frame':>10}")
+    for blueprint, frame in frames.items():
+        for encoding in CAMERA_ENCODINGS[blueprint]:
+            if encoding in ('png', 'class_png', 'instance_png'):
+                levels = PNG_LEVELS
+            else:
+                levels = [None]
+
+            for level in levels:
+                size, ms = benchmark(frame, encoding, level, args.repeats)
+                name = encoding if level is None else f'{encoding} (level {level})'
+                print(f"{blueprint:<38}{name:<24}{size:>10.3f}{ms:>10.1f}")
+
+if __name__ == '__main__':
+    main()
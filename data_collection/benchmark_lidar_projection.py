@@ -0,0 +1,88 @@
+# Benchmark for the lidar -> image projection in lidar_projection.py against the way project used to do it (copying
+# the cloud, homogeneous float64 coordinates, ...). It runs both on synthetic point clouds, checks that they keep the
+# same points at the same pixels and prints the ms/frame of each.
+#
+# python3 benchmark_lidar_projection.py                       -> 100k points, 1920x1080 camera at the lidar
+# python3 benchmark_lidar_projection.py --points 300000 --repeats 50
+
+import argparse
+import time
+import numpy as np
+
+from calibration import build_projection_matrix
+from lidar_projection import LidarProjector, UE4_TO_CAMERA
+
+# Points scattered around the sensor like a 64 channel lidar with 250m range would see them, roughly
+def make_synthetic_cloud(num_points, seed):
+    rng = np.random.default_rng(seed)
+    yaw = rng.uniform(-np.pi, np.pi, num_points)
+    pitch = np.radians(rng.uniform(-25, 30, num_points))
+    distance = rng.exponential(30, num_points).clip(1, 250)
+
+    cloud = np.empty((num_points, 4), dtype=np.float32)
+    cloud[:, 0] = distance * np.cos(pitch) * np.cos(yaw)
+    cloud[:, 1] = distance * np.cos(pitch) * np.sin(yaw)
+    cloud[:, 2] = distance * np.sin(pitch)
+    cloud[:, 3] = rng.uniform(0, 1, num_points)
+    return cloud
+
+# What project used to do
+def project_reference(cloud, K, image_w, image_h, lidar_2_camera):
+    p_cloud = np.copy(cloud)
+    intensity = np.array(p_cloud[:, 3])
+    distance = np.linalg.norm(np.array(p_cloud[:, :3]), axis=1)
+
+    local_lidar_points = np.array(p_cloud[:, :3]).T
+    local_lidar_points = np.r_[local_lidar_points, [np.ones(local_lidar_points.shape[1])]]
+    sensor_points = np.dot(lidar_2_camera, local_lidar_points)
+    point_in_camera_coords = np.dot(UE4_TO_CAMERA, sensor_points[:3])
+
+    points_2d = np.dot(K, point_in_camera_coords)
+    points_2d = np.array([points_2d[0, :] / points_2d[2, :], points_2d[1, :] / points_2d[2, :], points_2d[2, :]]).T
+
+    mask = (points_2d[:, 0] > 0.0) & (points_2d[:, 0] < image_w) & \
+        (points_2d[:, 1] > 0.0) & (points_2d[:, 1] < image_h) & (points_2d[:, 2] > 0.0)
+    points_2d = points_2d[mask]
+    u_coord = points_2d[:, 0].astype(int)
+    v_coord = points_2d[:, 1].astype(int)
+    return np.stack((v_coord, u_coord, 4 * intensity[mask] - 3, distance[mask]), axis=0)
+
+def time_ms(function, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return 1000 * np.median(times)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the lidar projection')
+    parser.add_argument('--points', type=int, default=100000, help='Number of points per cloud')
+    parser.add_argument('--width', type=int, default=1920, help='Width of the camera image')
+    parser.add_argument('--height', type=int, default=1080, help='Height of the camera image')
+    parser.add_argument('--fov', type=float, default=90, help='Horizontal fov of the camera')
+    parser.add_argument('--repeats', type=int, default=20, help='Number of frames to time')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the synthetic cloud')
+    args = parser.parse_args()
+
+    cloud = make_synthetic_cloud(args.points, args.seed)
+    K = build_projection_matrix(args.width, args.height, args.fov)
+    lidar_2_camera = np.identity(4) # mounted at the same spot, like in data_collection.py
+    projector = LidarProjector(K, args.width, args.height, lidar_2_camera)
+
+    old = project_reference(cloud, K, args.width, args.height, lidar_2_camera)
+    new = projector.project_points(cloud)
+
+    # float32 vs float64 can put a point right on a pixel border on either side of it, or in/out of the image
+    print(f"kept {new.shape[1]} points (old: {old.shape[1]})")
+    if new.shape == old.shape:
+        same_pixel = np.mean((new[0] == old[0]) & (new[1] == old[1]))
+        print(f"same pixel for {100 * same_pixel:.3f}% of the points, "
+              f"max distance difference {np.abs(new[3] - old[3]).max():.2e}m")
+
+    old_ms = time_ms(lambda: project_reference(cloud, K, args.width, args.height, lidar_2_camera), args.repeats)
+    new_ms = time_ms(lambda: projector.project_points(cloud), args.repeats)
+    print(f"old: {old_ms:.2f}ms/frame, new: {new_ms:.2f}ms/frame ({old_ms / new_ms:.1f}x faster)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+import carla
+import numpy as np
+
+# get_blueprint_library() is a round trip to the server and we used to call it for every car, twice for every walker,
+# and again for every camera and the ego vehicle. The library doesn't change while we run, so World fetches it once
+# into this cache. filter() results are kept per pattern, and on top of that we have pools: named lists of blueprints
+# (with optional weights) for when a filter pattern isn't enough, e.g. only the cars that have working lights.
+#
+# find() still hands out a fresh copy of the blueprint (like the library does), since cameras change the attributes of
+# their blueprint. The lists from filter()/pool() are shared, so attributes set on those stick around.
+class BlueprintCache():
+    def __init__(self, world: carla.World, rng = np.random):
+        self.library = world.get_blueprint_library()
+        # numpy's global generator by default, which World seeds
+        self.rng = rng
+        self.filtered = {}
+        self.pools = {}
+
+        # Our curated pools
+        vehicles = self.filter('vehicle.*.*')
+        self.add_pool('four_wheel_vehicles', [bp for bp in vehicles if bp.has_attribute('number_of_wheels') and
+                                              bp.get_attribute('number_of_wheels').as_int() == 4])
+        self.add_pool('light_rigged_vehicles', [bp for bp in vehicles if bp.has_attribute('has_lights') and
+                                                bp.get_attribute('has_lights').as_bool()])
+
+    def find(self, blueprint_id: str) -> carla.ActorBlueprint:
+        return self.library.find(blueprint_id)
+
+    def filter(self, pattern: str) -> list:
+        if pattern not in self.filtered:
+            self.filtered[pattern] = list(self.library.filter(pattern))
+        return self.filtered[pattern]
+
+    # weights can be a list with one weight per blueprint or a dict of blueprint id -> weight (missing ids get 1)
+    def add_pool(self, name: str, blueprints: list, weights = None):
+        blueprints = list(blueprints)
+        if isinstance(weights, dict):
+            weights = [weights.get(bp.id, 1.0) for bp in blueprints]
+        if weights is not None:
+            if len(weights) != len(blueprints):
+                raise ValueError(f'Pool {name} has {len(blueprints)} blueprints but {len(weights)} weights')
+            weights = np.asarray(weights, dtype=np.float64)
+            weights = weights / weights.sum()
+        self.pools[name] = (blueprints, weights)
+
+    def pool(self, name: str) -> list:
+        return self.pools[name][0]
+
+    # Pick a random blueprint from a pool, or from a filter pattern if there is no pool with that name
+    def sample(self, name_or_pattern: str) -> carla.ActorBlueprint:
+        if name_or_pattern in self.pools:
+            blueprints, weights = self.pools[name_or_pattern]
+        else:
+            blueprints, weights = self.filter(name_or_pattern), None
+
+        if len(blueprints) == 0:
+            raise ValueError(f'No blueprints for {name_or_pattern}')
+
+        # choosing an index draws the same random number np.random.choice(blueprints) did
+        if weights is None:
+            return blueprints[self.rng.choice(len(blueprints))]
+        return blueprints[self.rng.choice(len(blueprints), p=weights)]
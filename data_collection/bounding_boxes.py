@@ -2,19 +2,7 @@ import numpy as np
 import cv2
 from ego_vehicle import Camera
 import carla
-
-def build_projection_matrix(w, h, fov, is_behind_camera=False):
-    focal = w / (2.0 * np.tan(fov * np.pi / 360.0))
-    K = np.identity(3)
-
-    if is_behind_camera:
-        K[0, 0] = K[1, 1] = -focal
-    else:
-        K[0, 0] = K[1, 1] = focal
-
-    K[0, 2] = w / 2.0
-    K[1, 2] = h / 2.0
-    return K
+from calibration import build_projection_matrix
 
 def get_image_point(loc, K, w2c):
         # Calculate 2D projection of 3D coordinate
@@ -37,22 +25,16 @@ def get_image_point(loc, K, w2c):
 
         return point_img[0:2]
 
-def configure_matrices(camera: Camera):
-    camera_bp = camera.camera_blueprint
-    carla_camera = camera.camera
+# transform is the camera transform of the frame we project onto (the one of the last image by default)
+def configure_matrices(camera: Camera, transform: carla.Transform = None):
     # Get the world to camera matrix
-    world_to_camera = np.array(camera.transform_at_last_image.get_inverse_matrix())
+    if transform is None:
+        transform = camera.transform_at_last_image
+    world_to_camera = np.array(transform.get_inverse_matrix())
 
-    # Get the attributes from the camera
-    image_w = camera_bp.get_attribute("image_size_x").as_int()
-    image_h = camera_bp.get_attribute("image_size_y").as_int()
-    fov = camera_bp.get_attribute("fov").as_float()
-
-    # Calculate the camera projection matrix to project from 3D -> 2D
-    K = build_projection_matrix(image_w, image_h, fov)
-    K_b = build_projection_matrix(image_w, image_h, fov, is_behind_camera=True)
-
-    return world_to_camera, K, K_b
+    # The camera projection matrices to project from 3D -> 2D are made once when the camera is attached
+    # (see calibration.py)
+    return world_to_camera, camera.calibration.K, camera.calibration.K_b
 
 # This is an old implementation that gets the bounding boxes from the world when the function is called, rather than storing
 # the bounding boxes in the camera object at the moment the image is taken and using that information to draw the bounding boxes
@@ -109,59 +91,131 @@ def configure_matrices(camera: Camera):
 #                     cv2.line(img, (int(x_max),int(y_min)), (int(x_max),int(y_max)), (0,0,255, 255), 1)
 #     return img
 
-# This is the new implementation that uses the bounding boxes stored in the camera object. This is the one that works.
-def get_bb_img(world: carla.World, ego: carla.Vehicle, img: np.ndarray, camera: Camera) -> np.ndarray:
-    world_to_camera, K, K_b = configure_matrices(camera)
-    img = np.reshape(np.copy(img.raw_data), (img.height, img.width, 4))
+# Rotation part of carla.Transform.get_matrix() for arrays of pitch/yaw/roll in degrees, (N, 3, 3)
+def rotation_matrices(pitch, yaw, roll) -> np.ndarray:
+    pitch, yaw, roll = np.radians(pitch), np.radians(yaw), np.radians(roll)
+    cp, sp = np.cos(pitch), np.sin(pitch)
+    cy, sy = np.cos(yaw), np.sin(yaw)
+    cr, sr = np.cos(roll), np.sin(roll)
+
+    R = np.empty((len(pitch), 3, 3))
+    R[:, 0, 0] = cp * cy
+    R[:, 0, 1] = cy * sp * sr - sy * cr
+    R[:, 0, 2] = -cy * sp * cr - sy * sr
+    R[:, 1, 0] = cp * sy
+    R[:, 1, 1] = sy * sp * sr + cy * cr
+    R[:, 1, 2] = -sy * sp * cr + cy * sr
+    R[:, 2, 0] = sp
+    R[:, 2, 1] = -cp * sr
+    R[:, 2, 2] = cp * cr
+    return R
+
+# pitch/yaw/roll in degrees of (N, 3, 3) rotation matrices, the inverse of rotation_matrices (for |pitch| < 90), (N, 3)
+def euler_from_matrices(R: np.ndarray) -> np.ndarray:
+    pitch = np.arcsin(np.clip(R[:, 2, 0], -1, 1))
+    yaw = np.arctan2(R[:, 1, 0], R[:, 0, 0])
+    roll = np.arctan2(-R[:, 2, 1], R[:, 2, 2])
+    return np.degrees(np.stack([pitch, yaw, roll], axis=1))
+
+# The 8 corners of a box with extent 1, the order doesn't matter to us since we only take the min/max
+BOX_CORNERS = np.array([[x, y, z] for x in (-1, 1) for y in (-1, 1) for z in (-1, 1)], dtype=np.float64)
+
+# Same as bb.get_world_vertices(transform) for a list of boxes and their vehicle transforms at once, (N, 8, 3)
+def get_world_vertices(bbs: list, transforms: list) -> np.ndarray:
+    extents = np.array([[bb.extent.x, bb.extent.y, bb.extent.z] for bb in bbs], dtype=np.float64).reshape(-1, 3)
+    bb_locations = np.array([[bb.location.x, bb.location.y, bb.location.z] for bb in bbs], dtype=np.float64).reshape(-1, 3)
+    bb_rotations = np.array([[bb.rotation.pitch, bb.rotation.yaw, bb.rotation.roll] for bb in bbs], dtype=np.float64).reshape(-1, 3)
+    locations = np.array([[t.location.x, t.location.y, t.location.z] for t in transforms], dtype=np.float64).reshape(-1, 3)
+    rotations = np.array([[t.rotation.pitch, t.rotation.yaw, t.rotation.roll] for t in transforms], dtype=np.float64).reshape(-1, 3)
+
+    # box corners -> vehicle space (the box can be offset and rotated on the vehicle) -> world
+    vertices = BOX_CORNERS[None] * extents[:, None, :]
+    vertices = np.einsum('nij,nkj->nki', rotation_matrices(*bb_rotations.T), vertices) + bb_locations[:, None, :]
+    vertices = np.einsum('nij,nkj->nki', rotation_matrices(*rotations.T), vertices) + locations[:, None, :]
+    return vertices
+
+# get_image_point for an (M, 3) array of world points, (M, 2). Points behind the camera are projected with K_b.
+def get_image_points(points: np.ndarray, K: np.ndarray, K_b: np.ndarray, w2c: np.ndarray) -> np.ndarray:
+    points_camera = points @ w2c[:3, :3].T + w2c[:3, 3]
+
+    # UE4's coordinate system to the "standard" one, (x, y ,z) -> (y, -z, x)
+    points_camera = np.stack([points_camera[:, 1], -points_camera[:, 2], points_camera[:, 0]], axis=1)
+
+    behind = points_camera[:, 2] <= 0
+    points_img = points_camera @ K.T
+    if behind.any():
+        points_img[behind] = points_camera[behind] @ K_b.T
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return points_img[:, :2] / points_img[:, 2:3]
+
+# Finds the vehicles within max_distance and in front of the ego vehicle and projects the 8 vertices of their boxes
+# in one go. Returns a list of their (id, bb, transform), their distances to the ego vehicle, and the (N, 8, 3) world
+# vertices and (N, 8, 2) image points of their boxes.
+def project_vehicles(vehicle_locations: list, ego_id: int, world_to_camera: np.ndarray, K: np.ndarray, K_b: np.ndarray,
+                     max_distance: float = 100):
     ego_transform = None
-    for id, _, transform in camera.world_vehicles_locations_at_last_image:
-        if id == ego.id:
+    for id, _, transform in vehicle_locations:
+        if id == ego_id:
             ego_transform = transform
             break
     assert ego_transform is not None
 
-    for id, bb, transform in camera.world_vehicles_locations_at_last_image:
-
-        # Filter out the ego vehicle
-        if id != ego.id:
-
-            dist = transform.location.distance(ego_transform.location)
-
-            # Filter for the vehicles within 50m
-            if dist < 100:
-
-            # Calculate the dot product between the forward vector
-            # of the vehicle and the vector between the vehicle
-            # and the other vehicle. We threshold this dot product
-            # to limit to drawing bounding boxes IN FRONT OF THE CAMERA
-                forward_vec = ego_transform.get_forward_vector()
-                ray = transform.location - ego_transform.location
-
-                if forward_vec.dot(ray) > 0:
-                    p1 = get_image_point(bb.location, K, world_to_camera)
-                    verts = [v for v in bb.get_world_vertices(transform)]
-                    x_max = -10000
-                    x_min = 10000
-                    y_max = -10000
-                    y_min = 10000
-
-                    for vert in verts:
-                        p = get_image_point(vert, K, world_to_camera)
-                        # Find the rightmost vertex
-                        if p[0] > x_max:
-                            x_max = p[0]
-                        # Find the leftmost vertex
-                        if p[0] < x_min:
-                            x_min = p[0]
-                        # Find the highest vertex
-                        if p[1] > y_max:
-                            y_max = p[1]
-                        # Find the lowest  vertex
-                        if p[1] < y_min:
-                            y_min = p[1]
-
-                    cv2.line(img, (int(x_min),int(y_min)), (int(x_max),int(y_min)), (0,0,255, 255), 1)
-                    cv2.line(img, (int(x_min),int(y_max)), (int(x_max),int(y_max)), (0,0,255, 255), 1)
-                    cv2.line(img, (int(x_min),int(y_min)), (int(x_min),int(y_max)), (0,0,255, 255), 1)
-                    cv2.line(img, (int(x_max),int(y_min)), (int(x_max),int(y_max)), (0,0,255, 255), 1)
-    return img
\ No newline at end of file
+    others = [(id, bb, transform) for id, bb, transform in vehicle_locations if id != ego_id]
+    if not others:
+        return [], np.zeros(0), np.zeros((0, 8, 3)), np.zeros((0, 8, 2))
+
+    locations = np.array([[t.location.x, t.location.y, t.location.z] for _, _, t in others], dtype=np.float64)
+    ego_location = np.array([ego_transform.location.x, ego_transform.location.y, ego_transform.location.z])
+    forward = ego_transform.get_forward_vector()
+
+    # Filter for the vehicles within max_distance that are IN FRONT OF THE CAMERA (the dot product between the
+    # forward vector of the ego vehicle and the vector from it to the other vehicle is positive)
+    rays = locations - ego_location
+    distances = np.linalg.norm(rays, axis=1)
+    keep = (distances < max_distance) & (rays @ np.array([forward.x, forward.y, forward.z]) > 0)
+    if not keep.any():
+        return [], np.zeros(0), np.zeros((0, 8, 3)), np.zeros((0, 8, 2))
+
+    kept = [others[i] for i in np.flatnonzero(keep)]
+    vertices = get_world_vertices([bb for _, bb, _ in kept], [transform for _, _, transform in kept])
+    points = get_image_points(vertices.reshape(-1, 3), K, K_b, world_to_camera).reshape(-1, 8, 2)
+    return kept, distances[keep], vertices, points
+
+# (N, 4) x_min, y_min, x_max, y_max boxes around (N, 8, 2) projected vertices, clipped to the image if image_w/image_h
+# are given. Boxes that are completely outside the image end up with no area.
+def boxes_from_points(points: np.ndarray, image_w: float = None, image_h: float = None) -> np.ndarray:
+    boxes = np.concatenate([points.min(axis=1), points.max(axis=1)], axis=1)
+    if image_w is not None:
+        boxes[:, [0, 2]] = np.clip(boxes[:, [0, 2]], 0, image_w - 1)
+    if image_h is not None:
+        boxes[:, [1, 3]] = np.clip(boxes[:, [1, 3]], 0, image_h - 1)
+    return boxes
+
+# Returns the ids of the vehicles project_vehicles keeps and their (N, 4) boxes clipped to the image, which is assumed
+# to be centered on the principal point of K.
+def project_bounding_boxes(vehicle_locations: list, ego_id: int, world_to_camera: np.ndarray, K: np.ndarray,
+                           K_b: np.ndarray, max_distance: float = 100):
+    kept, _, _, points = project_vehicles(vehicle_locations, ego_id, world_to_camera, K, K_b, max_distance)
+    ids = np.array([id for id, _, _ in kept], dtype=np.int64)
+    return ids, boxes_from_points(points, 2 * K[0, 2], 2 * K[1, 2])
+
+# This is the new implementation that uses the bounding boxes stored in the camera object. This is the one that works.
+# It used to project the 8 vertices of every vehicle one at a time with get_image_point, now project_bounding_boxes does
+# all of them with one matrix multiply.
+# vehicle_locations and transform are the ones of the frame of img (a SensorFrame has them), the ones of the camera's
+# last image by default
+def get_bb_img(world: carla.World, ego: carla.Vehicle, img: np.ndarray, camera: Camera, vehicle_locations: list = None,
+               transform: carla.Transform = None) -> np.ndarray:
+    world_to_camera, K, K_b = configure_matrices(camera, transform)
+    img = np.reshape(np.copy(img.raw_data), (img.height, img.width, 4))
+
+    if vehicle_locations is None:
+        vehicle_locations = camera.world_vehicles_locations_at_last_image
+    _, boxes = project_bounding_boxes(vehicle_locations, ego.id, world_to_camera, K, K_b)
+    for x_min, y_min, x_max, y_max in boxes.astype(int):
+        # completely outside the image
+        if x_max <= x_min or y_max <= y_min:
+            continue
+        cv2.rectangle(img, (x_min, y_min), (x_max, y_max), (0,0,255, 255), 1)
+    return img
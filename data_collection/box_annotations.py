@@ -0,0 +1,141 @@
+import os
+import json
+import numpy as np
+from bounding_boxes import configure_matrices, project_vehicles, boxes_from_points, rotation_matrices, euler_from_matrices
+from categories import category_dict, base_type_category
+
+# The only labels we used to have came from running vis_data_annotation.py over the instance_seg images afterwards,
+# which takes hours. This writes the boxes of the vehicles around us while we collect instead, straight from the
+# projected 3D boxes: every rgb frame appends one line to boxes.jsonl with the image and its annotations, so a crash
+# only loses the frame that was being written (and a resumed run just keeps appending). close() turns the lines into a
+# COCO style boxes_coco.json (one run is small enough to do that in memory). Besides the usual COCO fields every
+# annotation has the actor id, the distance to the ego vehicle, how much of the box is outside the image (truncation),
+# an estimate of how much of it is hidden behind closer vehicles (occlusion) and the 3D box.
+# The category ids are the ones vis_data_annotation.py uses (see categories.py), vans count as cars.
+VEHICLE_CATEGORIES = ['car', 'truck', 'bus', 'motorcycle', 'bicycle']
+CATEGORIES = [{'supercategory': 'actor', 'id': category_dict[name], 'name': name} for name in VEHICLE_CATEGORIES]
+
+# Fraction of every box covered by the boxes of closer vehicles. The boxes are drawn nearest first on a grid of
+# cell x cell pixel cells, so a box counts as hidden where any closer box already is (a box is a loose outline of the
+# vehicle, so this overestimates a bit).
+def estimate_occlusion(boxes: np.ndarray, distances: np.ndarray, image_w: int, image_h: int, cell: int = 8) -> np.ndarray:
+    occlusion = np.zeros(len(boxes))
+    grid = np.zeros((image_h // cell + 1, image_w // cell + 1), dtype=bool)
+    cells = (boxes // cell).astype(int)
+    for i in np.argsort(distances):
+        # clipped away completely, nothing to hide behind
+        if boxes[i, 2] <= boxes[i, 0] or boxes[i, 3] <= boxes[i, 1]:
+            occlusion[i] = 1.0
+            continue
+        x_min, y_min, x_max, y_max = cells[i]
+        covered = grid[y_min:y_max + 1, x_min:x_max + 1]
+        occlusion[i] = covered.mean()
+        covered[:] = True
+    return occlusion
+
+class BoxAnnotationWriter():
+    def __init__(self, out_dir: str, max_distance: float = 100, min_area: float = 16):
+        self.out_dir = out_dir
+        self.max_distance = max_distance
+        self.min_area = min_area
+        self.jsonl_path = os.path.join(out_dir, 'boxes.jsonl')
+        self.json_path = os.path.join(out_dir, 'boxes_coco.json')
+
+        self.file = open(self.jsonl_path, 'a')
+        # so the next line doesn't get glued to one that was cut off by a crash
+        if self.file.tell() > 0:
+            with open(self.jsonl_path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    self.file.write('\n')
+
+    # sensor_frame is a SensorFrame (see frame_sync.py) of an rgb camera
+    def add_frame(self, sensor_frame, ego_id: int):
+        camera = sensor_frame.camera
+        image = sensor_frame.data
+        world_to_camera, K, K_b = configure_matrices(camera, sensor_frame.transform)
+        kept, distances, vertices, points = project_vehicles(sensor_frame.vehicle_locations, ego_id,
+                                                            world_to_camera, K, K_b, self.max_distance)
+
+        image_entry = {'file_name': os.path.relpath(sensor_frame.path, self.out_dir), 'width': image.width,
+                       'height': image.height, 'frame': image.frame, 'counter': sensor_frame.counter}
+        annotations = []
+        if kept:
+            boxes = boxes_from_points(points, image.width, image.height)
+            areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+
+            # Truncation is how much of the box is outside the image: 1 - the clipped box area over the area of the
+            # box without clipping. The vertices behind the camera are projected with K_b, which is fine for drawing
+            # the clipped box but says nothing about how big the box would be, so the unclipped box is the one
+            # around the vertices in front of the camera (and the clipped box). For a box that reaches behind the
+            # camera this underestimates, its real projection has no bound.
+            in_front = (vertices @ world_to_camera[:3, :3].T + world_to_camera[:3, 3])[..., 0] > 0
+            full_boxes = np.concatenate([
+                np.minimum(np.where(in_front[..., None], points, np.inf).min(axis=1), boxes[:, :2]),
+                np.maximum(np.where(in_front[..., None], points, -np.inf).max(axis=1), boxes[:, 2:])], axis=1)
+            full_areas = (full_boxes[:, 2] - full_boxes[:, 0]) * (full_boxes[:, 3] - full_boxes[:, 1])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                truncation = np.clip(1 - areas / full_areas, 0, 1)
+            # clipped away completely, or nothing of it in front of the camera
+            truncation[~(areas > 0) | ~in_front.any(axis=1)] = 1.0
+            occlusion = estimate_occlusion(boxes, distances, image.width, image.height)
+
+            # The box's rotation in the world is the vehicle's rotation composed with the box's rotation on the vehicle
+            # (adding up the angles only works for yaw)
+            vehicle_rotations = np.array([[t.rotation.pitch, t.rotation.yaw, t.rotation.roll] for _, _, t in kept])
+            bb_rotations = np.array([[bb.rotation.pitch, bb.rotation.yaw, bb.rotation.roll] for _, bb, _ in kept])
+            rotations = euler_from_matrices(rotation_matrices(*vehicle_rotations.T) @ rotation_matrices(*bb_rotations.T))
+
+            for i, (id, bb, transform) in enumerate(kept):
+                if areas[i] < self.min_area:
+                    continue
+                x_min, y_min, x_max, y_max = boxes[i]
+                category = sensor_frame.vehicle_classes.get(id, 'car')
+                category = base_type_category.get(category, category)
+                annotations.append({
+                    'category_id': category_dict[category] if category in VEHICLE_CATEGORIES else category_dict['car'],
+                    'bbox': [float(x_min), float(y_min), float(x_max - x_min), float(y_max - y_min)],
+                    'area': float(areas[i]),
+                    'iscrowd': 0,
+                    'actor_id': int(id),
+                    'distance': float(distances[i]),
+                    'truncation': float(truncation[i]),
+                    'occlusion': float(occlusion[i]),
+                    'bbox_3d': {
+                        'center': vertices[i].mean(axis=0).tolist(),
+                        'extent': [bb.extent.x, bb.extent.y, bb.extent.z],
+                        'rotation': rotations[i].tolist(),
+                        'vertices_2d': points[i].tolist(),
+                    },
+                })
+
+        self.file.write(json.dumps({'image': image_entry, 'annotations': annotations}) + '\n')
+        self.file.flush()
+
+    # Builds boxes_coco.json from boxes.jsonl. A frame that shows up more than once (it was saved again after
+    # resuming) keeps its last line.
+    def write_coco(self):
+        frames = {}
+        with open(self.jsonl_path, 'r') as f:
+            for line in f:
+                try:
+                    frame = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                frames[frame['image']['file_name']] = frame
+
+        images = []
+        annotations = []
+        for image_id, frame in enumerate(frames.values(), start=1):
+            images.append({'id': image_id, **frame['image']})
+            for annotation in frame['annotations']:
+                annotations.append({'id': len(annotations) + 1, 'image_id': image_id, **annotation})
+
+        with open(self.json_path, 'w') as f:
+            json.dump({'categories': CATEGORIES, 'images': images, 'annotations': annotations}, f)
+        print(f"Wrote {len(annotations)} boxes for {len(images)} images to {self.json_path}")
+
+    def close(self, write_coco: bool = True):
+        self.file.close()
+        if write_coco:
+            self.write_coco()
@@ -0,0 +1,70 @@
+import json
+import carla
+import numpy as np
+
+# Everything about a sensor that doesn't change while we collect: the camera matrices (K, and K_b for points behind
+# the camera, see bounding_boxes.py) and where the sensor is mounted on the ego vehicle. These used to be rebuilt from
+# the blueprint attributes for every frame, and the lidar projection asked the server for the camera transform twice
+# per frame. Camera.set_actor makes one of these when the sensor is attached, and data_collection.py writes them all
+# to calibration.json in the output dir.
+#
+# All the matrices are in CARLA's (UE4) coordinates: x forward, y right, z up. K and K_b expect points that have been
+# swapped to the usual camera coordinates first, (x, y, z) -> (y, -z, x).
+def build_projection_matrix(w, h, fov, is_behind_camera=False):
+    focal = w / (2.0 * np.tan(fov * np.pi / 360.0))
+    K = np.identity(3)
+
+    if is_behind_camera:
+        K[0, 0] = K[1, 1] = -focal
+    else:
+        K[0, 0] = K[1, 1] = focal
+
+    K[0, 2] = w / 2.0
+    K[1, 2] = h / 2.0
+    return K
+
+class SensorCalibration():
+    def __init__(self, name: str, blueprint: carla.ActorBlueprint, mount: carla.Transform):
+        self.name = name
+        self.sensor_type = blueprint.id
+
+        # 4x4 sensor -> ego vehicle and the other way around. Both sensors are rigidly attached to the ego vehicle, so
+        # going from one sensor to the other is always the same matrix (see sensor_to_sensor).
+        self.extrinsic = np.array(mount.get_matrix())
+        self.inverse_extrinsic = np.array(mount.get_inverse_matrix())
+
+        self.image_w = None
+        self.image_h = None
+        self.fov = None
+        self.K = None
+        self.K_b = None
+        if blueprint.has_attribute('image_size_x'):
+            self.image_w = blueprint.get_attribute('image_size_x').as_int()
+            self.image_h = blueprint.get_attribute('image_size_y').as_int()
+            self.fov = blueprint.get_attribute('fov').as_float()
+            self.K = build_projection_matrix(self.image_w, self.image_h, self.fov)
+            self.K_b = build_projection_matrix(self.image_w, self.image_h, self.fov, is_behind_camera=True)
+
+    # 4x4 matrix taking points from this sensor's space to other's
+    def sensor_to_sensor(self, other) -> np.ndarray:
+        return other.inverse_extrinsic @ self.extrinsic
+
+    def to_dict(self) -> dict:
+        calibration = {'name': self.name, 'type': self.sensor_type, 'extrinsic': self.extrinsic.tolist()}
+        if self.K is not None:
+            calibration.update({'image_w': self.image_w, 'image_h': self.image_h, 'fov': self.fov,
+                                'K': self.K.tolist(), 'K_b': self.K_b.tolist()})
+        return calibration
+
+# Writes every sensor and, for every lidar/camera pair, the lidar -> camera transform
+def save_calibration(path: str, calibrations: list):
+    cameras = [calibration for calibration in calibrations if calibration.K is not None]
+    lidars = [calibration for calibration in calibrations if calibration.sensor_type.startswith('sensor.lidar')]
+
+    with open(path, 'w') as f:
+        json.dump({
+            'sensors': [calibration.to_dict() for calibration in calibrations],
+            'lidar_to_camera': [{'lidar': lidar.name, 'camera': camera.name,
+                                 'transform': lidar.sensor_to_sensor(camera).tolist()}
+                                for lidar in lidars for camera in cameras],
+        }, f, indent=4)
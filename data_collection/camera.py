@@ -1,28 +1,88 @@
 import carla
 import os
+import threading
+import time
+import numpy as np
+from disk_writer import DiskWriter
+from blueprint_cache import BlueprintCache
+from calibration import SensorCalibration
+from frame_sync import SensorFrame
+from frame_encoding import ENCODING_EXTENSIONS, write_frame
 
-def get_vehicle_locations(world):
+def get_vehicle_locations(world, snapshot = None, classes: dict = None):
     # This is a tuple of the vehicle id, the bounding box, and the transform
+    # The transforms come from the world snapshot instead of one get_transform() per vehicle, so they all belong to the
+    # same frame, and we make our own copies of the bounding boxes and transforms so nothing refers back to live actors.
+    # (This used to say we were keeping references that somehow worked, the snapshot is the proper way to do that.)
+    # If classes is given it gets the base_type of every vehicle (car, truck, van, ...) by id.
+    if snapshot is None:
+        snapshot = world.get_snapshot()
+
     vehicle_locations = []
     for npc in world.get_actors().filter('*vehicle*'):
+        actor_snapshot = snapshot.find(npc.id)
+        if actor_snapshot is None:
+            # spawned after the snapshot was taken
+            continue
+
         id = npc.id
+        transform = actor_snapshot.get_transform()
+        transform = carla.Transform(carla.Location(transform.location.x, transform.location.y, transform.location.z),
+                                    carla.Rotation(transform.rotation.pitch, transform.rotation.yaw, transform.rotation.roll))
+
         bb = npc.bounding_box
-        transform = npc.get_transform()
-        
-        # ! Warning:
-        # * So, the thought process behind doing all this is to guarantee that the bounding boxes we get are
-        # * taken in the same frame as the image, since we had problems where the boxes were in front/behind (temporally)
-        # * where they should have been. Somehow doing this seems to have improved the situation, though there is still some 
-        # * misalignment. The weird thing is, as I see it, these tuples contain references to the actual objects, so they should
-        # * be updated in real time, and I should not actually be saving any information -- I don't know why this appears to work.
-        # * I tried using copy or deeopcopy, but the carla objects are not pickleable, and I don't feel like implementing a custom
-        # * deepcopy function for them. I'm not sure what's going on here, but I'm not going to mess with it unless the misalignment
-        # * turns out to be a problem.
-        # * If someone feels like it, try taking this hack where we save the values out and using the commented out bounding box method in
-        # * data_collection/bounding_boxes.py and see if it works. I'm not going to do it because I don't want to mess with it.
-        vehicle_locations.append((id, bb, transform))
+        bb_copy = carla.BoundingBox(carla.Location(bb.location.x, bb.location.y, bb.location.z),
+                                    carla.Vector3D(bb.extent.x, bb.extent.y, bb.extent.z))
+        bb_copy.rotation = carla.Rotation(bb.rotation.pitch, bb.rotation.yaw, bb.rotation.roll)
+
+        vehicle_locations.append((id, bb_copy, transform))
+        if classes is not None:
+            classes[id] = npc.attributes.get('base_type', '').lower()
     return vehicle_locations
 
+# Every camera used to call get_vehicle_locations in its own callback, so with 3-4 sensors we asked the server for the
+# same vehicles 3-4 times per frame (and the answers could come from different frames). This cache is shared by all the
+# cameras: the first camera to ask for a frame builds it and the rest get the same list back.
+class VehicleLocationCache():
+    def __init__(self, world: carla.World):
+        self.world = world
+        self.lock = threading.Lock()
+        self.frame = None
+        self.snapshot = None
+        self.vehicle_locations = None
+        self.vehicle_classes = None
+
+    def _update(self):
+        # callers hold the lock
+        snapshot = self.world.get_snapshot()
+        if snapshot.frame != self.frame:
+            self.frame = snapshot.frame
+            self.snapshot = snapshot
+            self.vehicle_classes = {}
+            self.vehicle_locations = get_vehicle_locations(self.world, snapshot, self.vehicle_classes)
+
+    def get(self):
+        with self.lock:
+            self._update()
+            return self.vehicle_locations
+
+    # The vehicle locations and the base_type of every vehicle by id, from the same frame
+    def get_with_classes(self):
+        with self.lock:
+            self._update()
+            return self.vehicle_locations, self.vehicle_classes
+
+    # Transform of any actor (e.g. a camera) in the same snapshot as the vehicle locations
+    def get_transform(self, actor: carla.Actor) -> carla.Transform:
+        with self.lock:
+            self._update()
+            actor_snapshot = self.snapshot.find(actor.id)
+        if actor_snapshot is None:
+            return actor.get_transform()
+        transform = actor_snapshot.get_transform()
+        return carla.Transform(carla.Location(transform.location.x, transform.location.y, transform.location.z),
+                               carla.Rotation(transform.rotation.pitch, transform.rotation.yaw, transform.rotation.roll))
+
 # This is the annoying thing: this camera just describes a blueprint with attributes and a listen function configured as we desire
 # We make this type of camera, with some settings, and pass it to the ego vehicle,
 # which actually uses the data in the object to spawn a camera actor. Thus, we only actually
@@ -30,13 +90,16 @@ def get_vehicle_locations(world):
 # This is pretty bad organization and I should fix this. Sorry :(
 class Camera():
     def __init__(self, world: carla.World, sensor_queue, blueprint: str, transform: carla.Transform, 
-                 name, file_type, cc = None, out_dir = ".", seconds_per_tick = 0, video_mode_state = False, video_wait = 0, video_images_saved = 0):
+                 name, file_type, cc = None, out_dir = ".", seconds_per_tick = 0, video_mode_state = False, video_wait = 0, video_images_saved = 0,
+                 writer_threads = 0, writer_queue_size = 16, encoding = None, png_compression = None,
+                 vehicle_cache = None, blueprints: BlueprintCache = None):
         self.blueprint: str = blueprint
         self.transform = transform
         self.counter = 0
         self.sensor_queue = sensor_queue
 
-        blueprint_library = world.get_blueprint_library()
+        # Use World's blueprint cache if we get one instead of fetching the library again
+        blueprint_library = blueprints if blueprints is not None else world.get_blueprint_library()
         self.camera_blueprint: carla.ActorBlueprint = blueprint_library.find(blueprint)
         self.transform = carla.Transform(carla.Location(x=1.5, z=2.4))
             
@@ -49,17 +112,56 @@ class Camera():
 
         self.has_new_image = False
         self.camera: carla.Actor = None
+        self.calibration: SensorCalibration = None
 
         self.world = world
+        # Pass the same cache to all the cameras so they share the vehicle locations per frame
+        self.vehicle_cache = vehicle_cache if vehicle_cache is not None else VehicleLocationCache(world)
         self.world_vehicles_locations_at_last_image = None
+        self.vehicle_classes_at_last_image = None
         self.transform_at_last_image = None
+        self.path_at_last_image = None
 
         self.video_mode = video_mode_state
         self.video_images_saved = video_images_saved
         self.video_images_wait = video_wait
+        # Counter of the first image to save, when resuming a run we throw away the images of the videos we already have
+        # (see run_manifest.py)
+        self.resume_counter = 0
+        # TickProfiler (see tick_profiler.py) the callback reports its time to, if we profile
+        self.profiler = None
+
+        # Bookkeeping for VideoSensorScheduler (see video_scheduler.py), which puts the sensor to sleep during the wait
+        # between videos. last_frame/frame_period are the simulator frame of the last image we got and the number of
+        # frames between images, next_frame is the next frame the sensor would have sent us while it sleeps.
+        self.state_lock = threading.Lock()
+        self.sleeping = False
+        self.last_frame = None
+        self.frame_period = None
+        self.next_frame = None
+
+        # With writer_threads > 0, camera images are copied out of the callback and written to disk in the background
+        # by a DiskWriter instead of calling save_to_disk in the callback. We only do this for the cameras with the raw
+        # color converter (which is all of ours), anything else (lidar, other converters) still uses save_to_disk.
+        # encoding picks how the frames are stored (see frame_encoding.py) and overrides file_type. With no encoding
+        # the frames are written as png like save_to_disk would.
+        raw_camera = blueprint.startswith('sensor.camera') and (cc is None or cc == carla.ColorConverter.Raw)
+        if encoding is not None:
+            if not raw_camera:
+                raise ValueError(f'{name}: encodings only work for cameras with the raw color converter')
+            self.file_type = ENCODING_EXTENSIONS[encoding]
+        self.encoding = encoding
+        self.png_compression = png_compression
+
+        self.writer = None
+        if writer_threads > 0 and raw_camera:
+            self.writer = DiskWriter(writer_threads, writer_queue_size, name = f'{name}_writer',
+                                     encoding = encoding or 'png', png_compression = png_compression)
 
     def set_actor(self, actor):
         self.camera = actor
+        # the blueprint and the mount are final once the sensor is spawned
+        self.calibration = SensorCalibration(self.name, self.camera_blueprint, self.transform)
 
     def configure_experiment(self, num_images_per_weather, weathers):
         self.num_images_per_weather = num_images_per_weather
@@ -81,28 +183,96 @@ class Camera():
     def set_shutter_speed(self, speed = 60):
         self.camera_blueprint.set_attribute('shutter_speed', str(speed))
     
+    def is_wait_frame(self, counter = None) -> bool:
+        # In video mode, is the image with this counter one we throw away between videos (or in a video we already
+        # saved before resuming)
+        if counter is None:
+            counter = self.counter
+        return self.video_mode and (counter < self.resume_counter or
+                                    (counter % (self.video_images_wait + self.video_images_saved)) >= self.video_images_saved)
+
+    # In video mode, how many videos this camera has completely written to disk (None if it can't tell right now
+    # because the writer is still busy)
+    def videos_on_disk(self):
+        if self.writer is not None and self.writer.pending() > 0:
+            return None
+        if self.counter < self.video_images_saved:
+            return 0
+        return (self.counter - self.video_images_saved) // (self.video_images_wait + self.video_images_saved) + 1
+
     def listen(self, image):
-        print(f"{self.name}, {self.counter}, {self.world.get_snapshot().frame}")
-        if self.video_mode and (self.counter % (self.video_images_wait + self.video_images_saved)) >= self.video_images_saved:
-            self.increment()
-            return
-        self.world_vehicles_locations_at_last_image = get_vehicle_locations(self.world)
+        callback_start = time.perf_counter()
+        with self.state_lock:
+            if self.sleeping:
+                # came in after the scheduler put us to sleep, the scheduler counts it for us
+                return
+
+            if self.next_frame is not None:
+                # first image after waking up, if the sensor didn't fire exactly when the scheduler expected
+                # move the counter to where it would have been
+                if self.frame_period:
+                    self.counter += round((image.frame - self.next_frame) / self.frame_period)
+                self.next_frame = None
+            elif self.last_frame is not None:
+                self.frame_period = image.frame - self.last_frame
+            self.last_frame = image.frame
+
+            # Check this before doing anything else, most frames in video mode are thrown away
+            if self.is_wait_frame():
+                self.increment()
+                return
+
+        print(f"{self.name}, {self.counter}, {image.frame}")
+        self.world_vehicles_locations_at_last_image, self.vehicle_classes_at_last_image = self.vehicle_cache.get_with_classes()
 
-        # ! Here too. See the comment above that says "Warning`"
-        self.transform_at_last_image = self.camera.get_transform()
+        # From the same snapshot as the vehicle locations
+        self.transform_at_last_image = self.vehicle_cache.get_transform(self.camera)
 
-        self.sensor_queue.put((image, self.blueprint))
         weather_name = self.weathers[self.counter // self.num_images_per_weather]
         image_path = os.path.join(self.out_dir, weather_name, self.name, f'{self.counter}.{self.file_type}')
-        if self.cc:
+        self.path_at_last_image = image_path
+        save_start = time.perf_counter()
+        size = None
+        if self.writer is not None:
+            # copy the BGRA buffer once, the writer threads take it from here
+            buffer = np.frombuffer(image.raw_data, dtype=np.uint8).reshape((image.height, image.width, 4)).copy()
+            self.writer.put(image_path, buffer)
+        elif self.encoding is not None:
+            buffer = np.frombuffer(image.raw_data, dtype=np.uint8).reshape((image.height, image.width, 4))
+            size = write_frame(image_path, buffer, self.encoding, self.png_compression)
+        elif self.cc:
             image.save_to_disk(image_path, self.cc)
         else:
             image.save_to_disk(image_path)
+
+        if self.profiler is not None:
+            self.profiler.record(f'save_{self.name}', save_start, time.perf_counter(), image.frame)
+            # the DiskWriter counts its own bytes
+            if self.writer is None:
+                self.profiler.add_bytes(self.name, size if size is not None else os.path.getsize(image_path))
+
+        # sensor_queue is the FrameSynchronizer that bundles the sensors per frame for check_has_image
+        self.sensor_queue.add(SensorFrame(self, image, self.counter, image_path, self.world_vehicles_locations_at_last_image,
+                                          self.vehicle_classes_at_last_image, self.transform_at_last_image))
         self.increment()
         self.has_new_image = True
+        if self.profiler is not None:
+            self.profiler.record(f'callback_{self.name}', callback_start, time.perf_counter(), image.frame)
     
     def increment(self):
         self.counter += 1
 
+    # Stop the sensor from sending us data (the server doesn't render sensors nobody listens to)
+    def sleep(self):
+        self.camera.stop()
+
+    def wake(self):
+        self.camera.listen(self.listen)
+
     def destroy(self):
-        self.camera.destroy()
\ No newline at end of file
+        self.camera.destroy()
+
+        # Make sure everything that is still queued makes it to disk
+        if self.writer is not None:
+            self.writer.close()
+            print(f"{self.name} writer: {self.writer.stats()}")
\ No newline at end of file
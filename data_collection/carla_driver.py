@@ -3,35 +3,98 @@ import sys
 import os
 import time
 import signal
+import socket
+import argparse
 import psutil
 from carla_flags import CARLA_DOWN, CARLA_RUNNING, COLLECTION_RUNNING, COLLECTION_COMPLETE, ALL_DONE
+from control_channel import ControlChannel, PeerDisconnected
+
+# carla_driver can run in an environment without the carla package, in that case we can only check that something is
+# listening on the RPC port
+try:
+    import carla
+except ImportError:
+    carla = None
+
+# The channel to data_collection_driver, so the signal handler can close it
+channel = None
 
 # This is if someone hits ctrl + C or something
 
 def signal_handler(sig, frame):
     print("\nReceived termination signal (Ctrl+C) for CARLA driver.")
     
-    with open("connector.txt", 'w') as f:
-        f.write(CARLA_DOWN)
+    # data_collection_driver sees the connection close right away
+    if channel is not None:
+        channel.close()
     
     sys.exit(0)  # Ensure the script exits cleanly
 
 # Register the signal handler for SIGINT (Ctrl+C)
 signal.signal(signal.SIGINT, signal_handler)
 
-def run_carla(args) -> int:
-    print("\nStarting CARLA")
-    # Activate virtual environment
-    command = ['./CarlaUE4.sh', *args]
-    process = subprocess.Popen(command, cwd='/Carla/CARLA_0.9.15')
-    pid = process.pid
-    time.sleep(60) # Give Carla some time to start
-    print("\nCARLA is running")
-    return process, pid
+# Whether something is accepting connections on host:port
+def port_open(host: str, port: int, timeout: float = 1.0) -> bool:
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+# Ask the server for its version with a short timeout. This only answers once the RPC server is up, which (unlike the
+# port just being open) means the map is loaded and we can go.
+def carla_ready(host: str, port: int, timeout: float = 2.0) -> bool:
+    if carla is None:
+        return port_open(host, port, timeout)
+    try:
+        client = carla.Client(host, port)
+        client.set_timeout(timeout)
+        client.get_server_version()
+        return True
+    except RuntimeError:
+        return False
+
+# Poll until CARLA answers, the process dies, or startup_timeout seconds pass. Returns whether it came up.
+def wait_for_carla_ready(process, host: str, port: int, startup_timeout: float, poll_interval: float = 1.0) -> bool:
+    deadline = time.monotonic() + startup_timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            print(f"\nCARLA exited with code {process.returncode} while starting")
+            return False
+        if carla_ready(host, port):
+            return True
+        time.sleep(poll_interval)
+    print(f"\nCARLA did not answer on {host}:{port} within {startup_timeout} seconds")
+    return False
+
+# We used to sleep 60 seconds here (and another 20 in main), now we start using CARLA as soon as it answers.
+# If it doesn't come up in startup_timeout seconds we kill it and try again.
+def run_carla(args, host: str = 'localhost', port: int = 2000, startup_timeout: float = 180, kill_timeout: float = 30,
+              all_carla: bool = True) -> int:
+    while True:
+        print("\nStarting CARLA")
+        start = time.monotonic()
+        # Activate virtual environment
+        command = ['./CarlaUE4.sh', *args, f'-carla-rpc-port={port}']
+        process = subprocess.Popen(command, cwd='/Carla/CARLA_0.9.15')
+        pid = process.pid
+
+        if wait_for_carla_ready(process, host, port, startup_timeout):
+            print(f"\nCARLA is running (cold start took {time.monotonic() - start:.1f}s)")
+            return process, pid
+
+        kill_carla(pid, host = host, port = port, kill_timeout = kill_timeout, all_carla = all_carla)
 
 # helper function for killing carla
-def __find_carla_pids():
-    """Find CARLA process PIDs safely."""
+def __find_carla_pids(root_pid: int = None):
+    """Find CARLA process PIDs safely. With root_pid only that process and its children (one of several servers)."""
+    if root_pid is not None:
+        try:
+            root = psutil.Process(root_pid)
+            return [root.pid] + [child.pid for child in root.children(recursive=True)]
+        except psutil.NoSuchProcess:
+            return []
+
     pids = []
     for proc in psutil.process_iter(['pid', 'name', 'cmdline']):
         try:
@@ -41,12 +104,34 @@ def __find_carla_pids():
             continue
     return pids
 
-def kill_carla(pid: int) -> int:
+# Wait until nothing is listening on the port anymore, so the next CARLA can bind it
+def wait_for_port_release(host: str, port: int, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while port_open(host, port, timeout = 0.5):
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.2)
+    return True
+
+# How much memory (GB) all the CARLA processes use together (or just the ones of the server started as pid)
+def carla_memory_gb(pid: int = None) -> float:
+    total = 0
+    for pid in __find_carla_pids(pid):
+        try:
+            total += psutil.Process(pid).memory_info().rss
+        except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+            continue
+    return total / 1024**3
+
+# all_carla kills every CARLA on the machine, to be sure nothing is left over. When several servers run side by side
+# (parallel_collection.py) pass all_carla = False to only kill the one started as pid.
+def kill_carla(pid: int, host: str = 'localhost', port: int = 2000, kill_timeout: float = 30, all_carla: bool = True) -> int:
     # I am going to comment out what we wrote and replace it with some gnarly stuff but it seems 
     # like we need to do more than just run kill to ensure that all running processes/used memory related 
     # to CARLA is killed/freed for a graceful stop+restart
     try:
         print("Killing CARLA")
+        start = time.monotonic()
 
 
         # os.kill(pid, signal.SIGTERM)
@@ -58,24 +143,43 @@ def kill_carla(pid: int) -> int:
 
 
     # Find CARLA PIDs
-        carla_pids = __find_carla_pids()
+        carla_pids = __find_carla_pids(None if all_carla else pid)
         if not carla_pids:
             print("\nNo CARLA process found.")
             return
 
-        # First, send SIGTERM (graceful shutdown)
+        procs = []
         for pid in carla_pids:
-            print(f"\nSending SIGTERM to CARLA process {pid}...")
-            os.kill(pid, signal.SIGTERM)
+            try:
+                procs.append(psutil.Process(pid))
+            except psutil.NoSuchProcess:
+                continue
 
-        # Wait a bit, then force kill if still running
-        time.sleep(2)
-        for pid in carla_pids:
-            if psutil.pid_exists(pid):
-                print(f"\nProcess {pid} is still running, sending SIGKILL...")
-                os.kill(pid, signal.SIGKILL)
+        # First, send SIGTERM (graceful shutdown)
+        for proc in procs:
+            print(f"\nSending SIGTERM to CARLA process {proc.pid}...")
+            try:
+                proc.terminate()
+            except psutil.NoSuchProcess:
+                continue
+
+        # Give them a bit to exit, then force kill the ones still running
+        _, alive = psutil.wait_procs(procs, timeout = min(5, kill_timeout))
+        for proc in alive:
+            print(f"\nProcess {proc.pid} is still running, sending SIGKILL...")
+            try:
+                proc.kill()
+            except psutil.NoSuchProcess:
+                continue
+        _, alive = psutil.wait_procs(alive, timeout = kill_timeout)
+        if alive:
+            print(f"\nProcesses {[proc.pid for proc in alive]} survived SIGKILL")
 
-        print("\nDone killing CARLA")
+        # Instead of sleeping 15 seconds, wait for the RPC port to be free for the next CARLA
+        if not wait_for_port_release(host, port, kill_timeout):
+            print(f"\nPort {port} is still in use after {kill_timeout} seconds")
+
+        print(f"\nDone killing CARLA ({time.monotonic() - start:.1f}s)")
         return 0
     except ProcessLookupError:
         print("Carla process not found")
@@ -84,44 +188,90 @@ def kill_carla(pid: int) -> int:
         print(f"Error while killing Carla process: {e}")
         return 1
 
+# Tell data_collection_driver flag, connecting first if it isn't connected. If it went away, wait for it to come back and
+# tell it whether CARLA is up instead (which is all it needs to know when it starts over). Returns the listener to pass
+# back in.
+def send_status(flag: str, process, listener):
+    global channel
+    while True:
+        if channel is None:
+            channel, listener = ControlChannel.listen(listener = listener)
+        try:
+            channel.send(flag)
+            return listener
+        except PeerDisconnected as e:
+            print(f"Lost data_collection_driver ({e}), waiting for it to reconnect")
+            channel.close()
+            channel = None
+            flag = CARLA_RUNNING if process.poll() is None else CARLA_DOWN
+
 # You do not need to activate the virtual environment as a subprocess because the subprocess will inherit the environment
 def main():
-    if os.path.exists("connector.txt"):
-        os.remove("connector.txt")
-    with open("connector.txt", 'w') as f:
-        f.write(CARLA_DOWN)
+    argparser = argparse.ArgumentParser(description='Starts CARLA and restarts it between data collection runs')
+    argparser.add_argument('--host', default='localhost', help='Where CARLA answers (default: localhost)')
+    argparser.add_argument('--port', default=2000, type=int, help='CARLA RPC port (default: 2000)')
+    argparser.add_argument('--startup_timeout', default=180, type=float,
+                           help='Seconds to wait for CARLA to answer before starting it again (default: 180)')
+    argparser.add_argument('--kill_timeout', default=30, type=float,
+                           help='Seconds to wait for CARLA to exit and free its port when killing it (default: 30)')
+    argparser.add_argument('--max_memory_growth', default=4.0, type=float,
+                           help='Restart CARLA once its memory grew by this many GB since the end of its first run (default: 4)')
+    argparser.add_argument('--restart_every_run', action='store_true',
+                           help='Restart CARLA after every run like we used to, instead of reusing it')
+    driver_args = argparser.parse_args()
+
+    global channel
+    listener = None
 
     while True:
         args = ['-prefernvidia', '-RenderOffScreen']
-        process, pid = run_carla(args)
-        time.sleep(20)
-
-        with open("connector.txt", 'w') as f:
-            f.write(CARLA_RUNNING)
+        process, pid = run_carla(args, host = driver_args.host, port = driver_args.port,
+                                 startup_timeout = driver_args.startup_timeout, kill_timeout = driver_args.kill_timeout)
+        # memory after the first run on this server, once the map and everything are loaded
+        baseline_memory = None
+        runs = 0
 
-        status = -1
-        while (status != COLLECTION_COMPLETE) or (status != ALL_DONE):
-            with open("connector.txt", 'r') as f:
-                status = f.read()
+        # Tell data_collection_driver that it can go (connecting first if it isn't connected yet)
+        listener = send_status(CARLA_RUNNING, process, listener)
 
-            # print(status)
+        while True:
+            try:
+                status = channel.recv(timeout = 1)
+            except PeerDisconnected as e:
+                # data_collection_driver died, wait for it to come back and tell it whether CARLA is up
+                print(f"Lost data_collection_driver ({e}), waiting for it to reconnect")
+                channel.close()
+                channel = None
+                listener = send_status(CARLA_RUNNING if process.poll() is None else CARLA_DOWN, process, listener)
+                if process.poll() is not None:
+                    break
+                continue
 
             if status == ALL_DONE:
                 print("Killing CARLA since data collection is done.")
-                kill_carla(pid)
+                kill_carla(pid, host = driver_args.host, port = driver_args.port, kill_timeout = driver_args.kill_timeout)
+                channel.close()
                 return
             elif status == COLLECTION_COMPLETE:
-                break
+                # The runs reset the world themselves (data_collection.py --warm_reset), so we keep this CARLA going
+                # for the next run unless it has been leaking memory
+                runs += 1
+                memory = carla_memory_gb()
+                if baseline_memory is None:
+                    baseline_memory = memory
+                print(f"Run {runs} on this CARLA done, using {memory:.2f}GB ({memory - baseline_memory:+.2f}GB since the first run)")
+                if driver_args.restart_every_run or process.poll() is not None or \
+                        memory - baseline_memory > driver_args.max_memory_growth:
+                    break
+                listener = send_status(CARLA_RUNNING, process, listener)
             elif process.poll() is not None: # if we're not done but the CARLA subprocess is no longer running then start it back up
-                f.write(CARLA_DOWN)
+                listener = send_status(CARLA_DOWN, process, listener)
                 break
-            time.sleep(1)
 
-        kill_carla(pid)
+        kill_carla(pid, host = driver_args.host, port = driver_args.port, kill_timeout = driver_args.kill_timeout)
         print("Restarting CARLA to continue data collection.")
-        time.sleep(15)
 
-    # call run_carla, when we get the pid back, we write to a file that data_collection_driver can read
+    # call run_carla, when we get the pid back, we send CARLA_RUNNING to data_collection_driver
     # that tells it is is now okay to start collecting data
     # then, we will wait for a signal from the data_collection_driver to kill the carla process
     # then we will kill carla, start it again, and repeat the process
@@ -3,6 +3,17 @@ CARLA_DOWN = '1'
 COLLECTION_RUNNING = '2'
 COLLECTION_COMPLETE = '3'
 ALL_DONE = '4'
+HEARTBEAT = '5'
+
+# The drivers send these to each other over a unix socket at CONTROL_ADDRESS (see control_channel.py), with a heartbeat
+# every HEARTBEAT_INTERVAL seconds. If nothing arrives for HEARTBEAT_TIMEOUT seconds the other side is considered dead.
+CONTROL_ADDRESS = 'carla_control.sock'
+HEARTBEAT_INTERVAL = 1.0
+HEARTBEAT_TIMEOUT = 10.0
+
+# data_collection.py exits with this when the output dir already has a run with different settings (see
+# run_manifest.py). Running it again won't change that, so the drivers don't retry it.
+SETTINGS_MISMATCH_EXIT_CODE = 3
 
 
 # this is just so we can repeat them  since it takes such a long time
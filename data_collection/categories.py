@@ -0,0 +1,18 @@
+# The category ids of our annotations, shared by vis_data_annotation.py (the COCO/VIS annotations made from the
+# instance_seg images) and box_annotations.py (the boxes written while collecting). They are CARLA's semantic tags of
+# the classes, the red channel of the instance_seg images.
+category_dict = {
+    'pedestrian' : 12,
+    'rider' : 13,
+    'car' : 14,
+    'truck' : 15,
+    'bus' : 16,
+    'train': 17,
+    'motorcycle' : 18,
+    'bicycle' : 19
+}
+
+# CARLA's base_type vehicle attribute -> our category, where they differ. Vans are tagged as cars in instance_seg.
+base_type_category = {
+    'van' : 'car',
+}
@@ -0,0 +1,94 @@
+import os
+import time
+import threading
+from multiprocessing.connection import Listener, Client
+from carla_flags import HEARTBEAT, CONTROL_ADDRESS, HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT
+
+# carla_driver.py and data_collection_driver.py used to talk by rewriting connector.txt and re-reading it every second.
+# That cost seconds per seed, could read a half written file, and left a stale flag behind after a crash.
+# Now they talk over a unix socket: carla_driver listens, data_collection_driver connects, and they send each other the
+# flags from carla_flags.py, which arrive right away. Both sides also send a HEARTBEAT every HEARTBEAT_INTERVAL seconds
+# from a background thread, so if one side dies (or hangs) the other finds out within HEARTBEAT_TIMEOUT seconds.
+
+class PeerDisconnected(Exception):
+    pass
+
+class ControlChannel():
+    def __init__(self, connection, heartbeat_interval: float = HEARTBEAT_INTERVAL, heartbeat_timeout: float = HEARTBEAT_TIMEOUT):
+        self.connection = connection
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.send_lock = threading.Lock()
+        self.last_seen = time.monotonic()
+
+        self.closed = threading.Event()
+        self.heartbeat_thread = threading.Thread(target=self._heartbeat, daemon=True)
+        self.heartbeat_thread.start()
+
+    # Wait for the other side to connect. Returns the channel and the listener, pass the listener back in to accept the
+    # next connection if the other side goes away.
+    @staticmethod
+    def listen(address: str = CONTROL_ADDRESS, listener: Listener = None):
+        if listener is None:
+            # left behind if we crashed last time
+            if os.path.exists(address):
+                os.remove(address)
+            listener = Listener(address, family='AF_UNIX')
+        print("Waiting for the other driver to connect...")
+        return ControlChannel(listener.accept()), listener
+
+    # Keep trying to connect until the other side is listening (or timeout runs out)
+    @staticmethod
+    def connect(address: str = CONTROL_ADDRESS, timeout: float = None):
+        start = time.monotonic()
+        while True:
+            try:
+                return ControlChannel(Client(address, family='AF_UNIX'))
+            except (FileNotFoundError, ConnectionRefusedError):
+                if timeout is not None and time.monotonic() - start > timeout:
+                    raise
+                time.sleep(0.2)
+
+    def _heartbeat(self):
+        while not self.closed.wait(self.heartbeat_interval):
+            try:
+                self.send(HEARTBEAT)
+            except (OSError, PeerDisconnected):
+                return
+
+    def send(self, flag: str):
+        try:
+            with self.send_lock:
+                self.connection.send(flag)
+        except (OSError, EOFError) as e:
+            raise PeerDisconnected(str(e))
+
+    # Returns the next flag, or None if nothing but heartbeats came in within timeout seconds (timeout = None waits
+    # forever). Raises PeerDisconnected if the other side closed the connection or stopped sending heartbeats.
+    def recv(self, timeout: float = None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.heartbeat_interval
+            if deadline is not None:
+                wait = max(0.0, min(wait, deadline - time.monotonic()))
+
+            try:
+                if self.connection.poll(wait):
+                    message = self.connection.recv()
+                    self.last_seen = time.monotonic()
+                    if message != HEARTBEAT:
+                        return message
+            except (OSError, EOFError) as e:
+                raise PeerDisconnected(str(e))
+
+            if time.monotonic() - self.last_seen > self.heartbeat_timeout:
+                raise PeerDisconnected(f'No heartbeat for {self.heartbeat_timeout} seconds')
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+
+    def close(self):
+        self.closed.set()
+        try:
+            self.connection.close()
+        except OSError:
+            pass
@@ -15,15 +15,23 @@ import carla
 import time
 import cv2
 import numpy as np
-from queue import Queue, Empty
 import argparse
 import json
 
 from ego_vehicle import Ego_Vehicle, Camera
+from camera import VehicleLocationCache
+from video_scheduler import VideoSensorScheduler
 from world import World
 import bounding_boxes as bb
 from bounding_boxes import get_image_point, configure_matrices
 from utilities import quantize_to_tick, check_next_weather, check_dead, check_has_image
+from frame_encoding import CAMERA_ENCODINGS
+from run_manifest import RunManifest, RunSettingsMismatch
+from carla_flags import SETTINGS_MISMATCH_EXIT_CODE
+from box_annotations import BoxAnnotationWriter
+from calibration import save_calibration
+from frame_sync import FrameSynchronizer
+from tick_profiler import TickProfiler
 
 # TODO:
 # - Fix data organization re: ego vehicle class and weather class
@@ -65,6 +73,27 @@ def main():
     parser.add_argument('--video_images_saved', type=int, default=None, help='Number of images to save in video mode')
     parser.add_argument('--videos_wanted', type=int, default=None, help='Number of images to wait for in video mode')
     parser.add_argument('--video_images_wait', type=int, default=None, help='Number of images to wait for in video mode')
+    parser.add_argument('--car_blueprints', type=str, default='vehicle.*.*', help='Blueprint filter or pool (four_wheel_vehicles, light_rigged_vehicles) to spawn the cars from')
+    parser.add_argument('--spawn_cars_batch', action='store_true', help='Spawn all the cars in one batch (faster, but a seed gets different traffic than with the default one by one spawning of older datasets)')
+    parser.add_argument('--walker_min_distance', type=float, default=0.0, help='Only spawn walkers at least this far (m) from the ego vehicle')
+    parser.add_argument('--walker_max_distance', type=float, default=None, help='Only spawn walkers at most this far (m) from the ego vehicle')
+    parser.add_argument('--sleep_sensors', action='store_true', help='In video mode, stop the sensors during the wait between videos')
+    parser.add_argument('--fast_forward', action='store_true', help='In video mode, turn off rendering during the wait between videos (implies --sleep_sensors)')
+    parser.add_argument('--writer_threads', type=int, default=2, help='Number of background threads writing images per camera (0 writes in the sensor callback)')
+    parser.add_argument('--writer_queue_size', type=int, default=16, help='Number of images per camera that can wait to be written before the sensor callback blocks')
+    parser.add_argument('--rgb_encoding', type=str, default='png', choices=CAMERA_ENCODINGS['sensor.camera.rgb'], help='How to store the rgb images')
+    parser.add_argument('--rgb_seg_encoding', type=str, default='png', choices=CAMERA_ENCODINGS['sensor.camera.semantic_segmentation'], help='How to store the semantic segmentation images')
+    parser.add_argument('--instance_seg_encoding', type=str, default='png', choices=CAMERA_ENCODINGS['sensor.camera.instance_segmentation'], help='How to store the instance segmentation images')
+    parser.add_argument('--host', type=str, default='localhost', help='CARLA server host')
+    parser.add_argument('--port', type=int, default=2000, help='CARLA server RPC port')
+    parser.add_argument('--tm_port', type=int, default=8000, help='Traffic manager port (has to be different for every server on this machine)')
+    parser.add_argument('--warm_reset', action='store_true', help='Reuse the world left by the last run on this server (clear its actors) instead of loading Town10HD again')
+    parser.add_argument('--no_resume', action='store_true', help='Start over instead of skipping what the manifest.jsonl in the output dir says is done')
+    parser.add_argument('--box_annotations', action='store_true', help='Write the 2D/3D boxes of the vehicles in every rgb image to boxes.jsonl (and boxes_coco.json at the end)')
+    parser.add_argument('--lidar_dense', type=str, default=None, choices=['npz', 'npy'], help='Also save the lidar as z-buffered float16 depth/intensity images (npz: compressed, npy: can be memory mapped)')
+    parser.add_argument('--profile', action='store_true', help='Time the phases of every tick and write profile.csv and profile_trace.json (Chrome trace) to the output dir')
+    parser.add_argument('--profile_parquet', action='store_true', help='With --profile, write profile.parquet instead of profile.csv (needs pandas and pyarrow)')
+    parser.add_argument('--png_compression', type=int, default=None, choices=range(10), help='zlib level for the png encodings (opencv default if not set)')
 
 
     args = parser.parse_args()
@@ -81,6 +110,9 @@ def main():
     video_images_saved = args.video_images_saved
     video_images_wait = args.video_images_wait
     videos_wanted = args.videos_wanted
+    writer_threads = args.writer_threads
+    writer_queue_size = args.writer_queue_size
+    png_compression = args.png_compression
 
 
 
@@ -102,6 +134,27 @@ def main():
     with open(path_to_args, 'w') as arg_file:
         json.dump(vars(args), arg_file, indent=4)
 
+    # Skip the run if it is done, or the videos that are done if it crashed before (see run_manifest.py)
+    # A settings mismatch exits with SETTINGS_MISMATCH_EXIT_CODE so the drivers don't keep retrying it
+    try:
+        run_manifest = RunManifest(out_dir, {'random_seed': random_seed, 'weather_config': weather_config,
+                                             'seconds_per_tick': seconds_per_tick, 'video_mode': video_mode,
+                                             'video_images_saved': video_images_saved, 'video_images_wait': video_images_wait,
+                                             'num_images_per_weather': num_images_per_weather},
+                                   resume = not args.no_resume)
+    except RunSettingsMismatch as e:
+        print(e)
+        sys.exit(SETTINGS_MISMATCH_EXIT_CODE)
+    if run_manifest.run_done:
+        print(f"{out_dir} is already done")
+        return
+    run_complete = False
+    box_writer = None
+    # bundles what every sensor saved per frame, see frame_sync.py
+    sensor_queue = FrameSynchronizer()
+    # per tick timings with --profile, see tick_profiler.py
+    profiler = TickProfiler(out_dir if args.profile else None, parquet = args.profile_parquet)
+
     
     try:
         sys.path.append(glob.glob('../carla/dist/carla-*%d.%d-%s.egg' % (
@@ -112,8 +165,8 @@ def main():
         pass
 
     try:
-        sensor_queue = Queue()
-        our_world = World('localhost', 2000, random_seed = random_seed) 
+        our_world = World(args.host, args.port, tm_port = args.tm_port, random_seed = random_seed, walker_location_grid = args.walker_max_distance is not None,
+                         warm_reset = args.warm_reset) 
         
         # Read our weather configurations from yaml and then set the first configuration to be the current weather
         our_world.load_weathers(weather_config)
@@ -124,17 +177,24 @@ def main():
         # Quantize the seconds per tick to the nearest multiple of the world delta seconds
         seconds_per_tick = quantize_to_tick(seconds_per_tick, our_world.world.get_settings().fixed_delta_seconds)
 
-        ego = Ego_Vehicle(our_world.world)
+        ego = Ego_Vehicle(our_world.world, blueprints = our_world.blueprints, tm_port = args.tm_port)
+
+        # Shared by all the cameras so the vehicle locations are only fetched once per frame
+        vehicle_cache = VehicleLocationCache(our_world.world)
 
         # I don't like how the ego vehicle and camera classes are organized. It's really unclear who is actually responsible for
         # configuring and spawning the camera actors. It feels like the camera class should be responsible for this, but it's not.
         # And we also configure a bunch of stuff in main and its all kind of terrible :/
         rgb_cam = Camera(our_world.world, sensor_queue, 'sensor.camera.rgb', carla.Transform(carla.Location(x=1.5, z=2.4)), 
                         name = 'rgb', file_type = 'png', cc = carla.ColorConverter.Raw, out_dir = out_dir,
-                        seconds_per_tick = seconds_per_tick, video_mode_state = video_mode, video_wait = video_images_wait, video_images_saved=video_images_saved)
+                        seconds_per_tick = seconds_per_tick, video_mode_state = video_mode, video_wait = video_images_wait, video_images_saved=video_images_saved,
+                        writer_threads = writer_threads, writer_queue_size = writer_queue_size,
+                        encoding = args.rgb_encoding, png_compression = png_compression, vehicle_cache = vehicle_cache, blueprints = our_world.blueprints)
         rgb_seg = Camera(our_world.world, sensor_queue, 'sensor.camera.semantic_segmentation', carla.Transform(carla.Location(x=1.5, z=2.4)),
                         name = 'rgb_seg', file_type = 'png', out_dir = out_dir,
-                        seconds_per_tick = seconds_per_tick, video_mode_state = video_mode, video_wait = video_images_wait, video_images_saved=video_images_saved)
+                        seconds_per_tick = seconds_per_tick, video_mode_state = video_mode, video_wait = video_images_wait, video_images_saved=video_images_saved,
+                        writer_threads = writer_threads, writer_queue_size = writer_queue_size,
+                        encoding = args.rgb_seg_encoding, png_compression = png_compression, vehicle_cache = vehicle_cache, blueprints = our_world.blueprints)
 
         rgb_cam.set_image_size()
         rgb_seg.set_image_size()
@@ -148,7 +208,8 @@ def main():
         if not video_mode:
             lidar_cam = Camera(our_world.world, sensor_queue, 'sensor.lidar.ray_cast', carla.Transform(carla.Location(x=1.5, z=2.4)),
                             name = 'lidar', file_type = 'ply', out_dir = out_dir,
-                            seconds_per_tick = seconds_per_tick, video_mode_state = video_mode, video_wait = video_images_wait, video_images_saved=video_images_saved)
+                            seconds_per_tick = seconds_per_tick, video_mode_state = video_mode, video_wait = video_images_wait, video_images_saved=video_images_saved,
+                            writer_threads = writer_threads, writer_queue_size = writer_queue_size, vehicle_cache = vehicle_cache, blueprints = our_world.blueprints)
             # lidar_seg = Camera(our_world.world, sensor_queue, 'sensor.lidar.ray_cast_semantic', carla.Transform(carla.Location(x=1.5, z=2.4)),
             #                 name = 'lidar_seg', file_type = 'ply', out_dir = out_dir,
             #                 seconds_per_tick = seconds_per_tick, video_mode_state = video_mode, video_wait = video_images_wait, video_images_saved=video_images_saved)
@@ -157,7 +218,9 @@ def main():
         else:
             instance_seg = Camera(our_world.world, sensor_queue, 'sensor.camera.instance_segmentation', carla.Transform(carla.Location(x=1.5, z=2.4)),
                             name = 'instance_seg', file_type = 'png', out_dir = out_dir,
-                            seconds_per_tick = seconds_per_tick, video_mode_state = video_mode, video_wait = video_images_wait, video_images_saved=video_images_saved)
+                            seconds_per_tick = seconds_per_tick, video_mode_state = video_mode, video_wait = video_images_wait, video_images_saved=video_images_saved,
+                            writer_threads = writer_threads, writer_queue_size = writer_queue_size,
+                            encoding = args.instance_seg_encoding, png_compression = png_compression, vehicle_cache = vehicle_cache, blueprints = our_world.blueprints)
             instance_seg.set_image_size()
             ego.add_camera(instance_seg)
 
@@ -165,43 +228,108 @@ def main():
         # It then passes this information to the camera objects, which are responsible for saving the images to different folders
         # based on which weather is currently active. This is a little convoluted, but it works.
         ego.configure_experiment(num_images_per_weather, [state['name'] for state in our_world.weather.states])
+        # K, K_b and the mounts of all the sensors, and the lidar -> camera transforms
+        save_calibration(os.path.join(out_dir, 'calibration.json'), [camera.calibration for camera in ego.cameras])
+
+        resume_counter = run_manifest.resume_counter(video_images_saved, video_images_wait) if video_mode else 0
+        for camera in ego.cameras:
+            camera.resume_counter = resume_counter
+            sensor_queue.register(camera)
+            if profiler.enabled:
+                camera.profiler = profiler
         
         # Spawn cars and walkers
-        spawned = our_world.spawn_car(number = car_count)
+        spawned = our_world.spawn_car(filter = args.car_blueprints, number = car_count, batch = args.spawn_cars_batch)
         print(f"spawned {spawned}/{car_count} attempted cars")
-        spawned = our_world.spawn_walker(number = walker_count)
+        if args.walker_min_distance > 0 or args.walker_max_distance is not None:
+            # the world hasn't ticked since the ego vehicle spawned (only the batch car spawn does), so it doesn't know
+            # where it is yet
+            spawned = our_world.spawn_walker(number = walker_count, near = ego.spawn_point.location,
+                                             min_distance = args.walker_min_distance, max_distance = args.walker_max_distance)
+        else:
+            spawned = our_world.spawn_walker(number = walker_count)
         print(f"spawned {spawned}/{walker_count} attempted walkers")
         
         # If we are drawing bounding boxes and visualizing them as we go, we need to create a window to display the images
         if draw_bounding_box and debug:
             cv2.namedWindow('ImageWindowName', cv2.WINDOW_AUTOSIZE)
 
+        # Stops the sensors from rendering the frames we throw away between videos, and with fast_forward
+        # stops rendering altogether during the wait
+        # (also when resuming, so the sensors sleep through the videos we already have)
+        scheduler = None
+        if video_mode and (args.sleep_sensors or args.fast_forward or resume_counter > 0):
+            scheduler = VideoSensorScheduler(ego.cameras, world = our_world.world, fast_forward = args.fast_forward)
+
+        if args.box_annotations:
+            box_writer = BoxAnnotationWriter(out_dir)
+
         last_photo_count = -1
         check_for_dead = True
-        our_world.world.tick() 
+        frame = our_world.world.tick()
+        sensor_queue.tick(frame)
+        profiler.next_frame(frame)
 
         while True:
             # Try and progress the weather to the next state if we have taken enough images for the current weather
-            last_photo_count = check_next_weather(ego, our_world, num_images_per_weather, last_photo_count)
+            with profiler.phase('check_next_weather'):
+                last_photo_count = check_next_weather(ego, our_world, num_images_per_weather, last_photo_count)
             if last_photo_count < -1:
                 print("at last photo count")
+                run_complete = True
+                # whatever is still waiting on a sensor
+                check_has_image(ego, sensor_queue, our_world, debug, draw_bounding_box, out_dir, box_writer, args.lidar_dense,
+                                flush = True, profiler = profiler)
                 break
 
             # Check for dead people every 15 frames. Delete their actors and spawn new ones
-            check_for_dead = check_dead(cur_image_num = ego.cameras[0].counter, check_for_dead = check_for_dead, world = our_world, interval = 15)
+            with profiler.phase('check_dead'):
+                check_for_dead = check_dead(cur_image_num = ego.cameras[0].counter, check_for_dead = check_for_dead, world = our_world, interval = 15)
 
             # Check if we have a new image and if so, process it
-            check_has_image(ego, sensor_queue, our_world, debug, draw_bounding_box, out_dir)
+            with profiler.phase('check_has_image'):
+                quit_pressed = check_has_image(ego, sensor_queue, our_world, debug, draw_bounding_box, out_dir, box_writer, args.lidar_dense,
+                                               profiler = profiler)
+            if quit_pressed:
+                print("q pressed, stopping")
+                break
             
             check_for_dead = True 
 
-            our_world.world.tick()  
+            with profiler.phase('world.tick'):
+                frame = our_world.world.tick()  
+            sensor_queue.tick(frame)
+
+            if scheduler is not None:
+                with profiler.phase('scheduler'):
+                    scheduler.step(frame)
+
+            with profiler.phase('run_manifest'):
+                run_manifest.update(ego.cameras)
+            profiler.next_frame(frame)
 
     finally:
         # These cameras are our camera objects so they need to destroy themselves
         for camera in ego.cameras:
             camera.destroy()
 
+        stats = sensor_queue.stats()
+        print(f"{stats['bundles']} frames, {stats['incomplete_bundles']} missing a sensor")
+        for name, sensor in stats['sensors'].items():
+            print(f"    {name}: {sensor['received']} received, {sensor['dropped']} dropped, "
+                  f"{sensor['mean_latency_ms']:.1f}ms mean / {sensor['max_latency_ms']:.1f}ms max after the tick")
+
+        # after destroy, so the DiskWriters have written everything
+        profiler.close(ego.cameras)
+
+        # the coco json only for a finished run, a crashed one keeps adding to boxes.jsonl when it resumes
+        if box_writer is not None:
+            box_writer.close(write_coco = run_complete)
+
+        # only now that the writers are flushed
+        if run_complete:
+            run_manifest.finish(ego.cameras)
+
         our_world.clean_up()
 
 
@@ -4,13 +4,15 @@ import os
 import time
 import signal
 import random
-from carla_flags import CARLA_DOWN, CARLA_RUNNING, COLLECTION_RUNNING, COLLECTION_COMPLETE, ALL_DONE, random_seeds
+from carla_flags import CARLA_DOWN, CARLA_RUNNING, COLLECTION_RUNNING, COLLECTION_COMPLETE, ALL_DONE, random_seeds, \
+    SETTINGS_MISMATCH_EXIT_CODE
+from control_channel import ControlChannel, PeerDisconnected
 
 # TODO have data_collection write the arguments to a file so we know what ran/how data was made -- DONE (I think)
 # TODO Implement piping
 # TODO DEBUG bc file is just saving 1 photo stopping
 # TODO subprocess should stop elegantly
-# TODO fix connector.txt if crashes
+# TODO fix connector.txt if crashes -- DONE, replaced connector.txt with a socket (control_channel.py)
 
 # im finna come in and attempt to fix the last 3
 
@@ -29,21 +31,16 @@ current lead: go to the part where we progress to the next weather and print he
  """
 
 
+# The channel to carla_driver, so the signal handler can close it
+channel = None
+
 # This is if someone hits Ctrl + C while this script is running
 def signal_handler(sig, frame):
     print("\nReceived termination signal (Ctrl+C) for data_collection_driver")
 
-    carla_down = False
-
-    with open("connector.txt", 'r') as f:
-        if f.read() == CARLA_DOWN:
-            carla_down = True
-    
-    with open("connector.txt", 'w') as f:
-        if carla_down:
-            f.write(CARLA_DOWN)
-        else:
-            f.write(CARLA_RUNNING)
+    # carla_driver sees the connection close right away and waits for us to come back
+    if channel is not None:
+        channel.close()
     
     sys.exit(0)  # Ensure the script exits cleanly
 
@@ -52,38 +49,87 @@ signal.signal(signal.SIGINT, signal_handler)
 
 
 
+# Whether CARLA is up, as far as carla_driver last told us
+carla_status = CARLA_DOWN
+
+def handle_message(status):
+    global carla_status
+    if status in (CARLA_RUNNING, CARLA_DOWN):
+        carla_status = status
+
+# carla_driver went away, wait for it to come back. Once it does it tells us whether CARLA is up.
+def reconnect(timeout = None):
+    global channel, carla_status
+    channel.close()
+    carla_status = CARLA_DOWN
+    channel = ControlChannel.connect(timeout = timeout)
+
+# Read whatever carla_driver sent, reconnecting if it went away. Returns after timeout seconds (None = until a message)
+def poll_channel(timeout = None):
+    try:
+        handle_message(channel.recv(timeout = timeout))
+    except PeerDisconnected as e:
+        print(f"Lost carla_driver ({e}), reconnecting")
+        reconnect()
+
+# Send flag to carla_driver. If it went away we reconnect and return False: the flag is lost and the new connection
+# starts over with carla_driver telling us whether CARLA is up, so the caller decides whether to send it again.
+def send_flag(flag, timeout = None) -> bool:
+    try:
+        channel.send(flag)
+        return True
+    except PeerDisconnected as e:
+        print(f"Lost carla_driver ({e}) while sending {flag}, reconnecting")
+        reconnect(timeout)
+        return False
+
+def wait_for_carla():
+    while carla_status != CARLA_RUNNING:
+        poll_channel()
+
 def run_collection(args) -> int:
     # Activate virtual environment
     command = ['python3', 'data_collection.py', *args]
     process = subprocess.Popen(command)
 
-    # Wait for the process to complete
-    process.wait()
+    # Wait for the process to complete, keep listening to carla_driver in the meantime
+    while process.poll() is None:
+        poll_channel(timeout = 1)
     return process.returncode
 
-# You do not need to activate the virtual environment as a subprocess because the subprocess will inherit the environment
-def main():
-    random.seed(234905)
+# What we collect, parallel_collection.py hands out the same runs
+num_videos = 650
+tick_rate = .166666667 # 6fps
+num_images_per_video = 18
+num_images_between_videos = 40
+
+MAX_IMAGES_PER_RUN = 400
+num_seeds = num_videos * (num_images_per_video + num_images_between_videos) // MAX_IMAGES_PER_RUN + 1
 
-    num_videos = 650
-    tick_rate = .166666667 # 6fps
-    num_images_per_video = 18
-    num_images_between_videos = 40
+num_videos_per_seed = (num_videos // num_seeds) +1
 
-    MAX_IMAGES_PER_RUN = 400
-    num_seeds = num_videos * (num_images_per_video + num_images_between_videos) // MAX_IMAGES_PER_RUN + 1
+# seeds = [random.randint(0, 10239584) for i in range(num_seeds)]
+seeds = random_seeds
 
-    num_videos_per_seed = (num_videos // num_seeds) +1
+# a list of strings which are yamls
+weathers = ["configs/foggy_day", "configs/rainy_day"] #["configs/clear_day", "configs/clear_night", "configs/clear_sunset", "configs/clear_wet_day", "configs/foggy_day", "configs/rainy_day"] 
 
+# The data_collection.py arguments for one (weather, seed) run. parallel_collection.py uses this too.
+def collection_args(weather: str, seed: str) -> list:
+    return ['--weather_config', f'{weather}.yaml', '--random_seed', str(seed),
+            '--videos_wanted', str(num_videos_per_seed), '--video_images_wait', str(num_images_between_videos),
+            '--video_images_saved', str(num_images_per_video), '--seconds_per_tick', str(tick_rate), '--video_mode', '--warm_reset',
+            '--output_dir', f'/Data/video_data/{weather[8:]}-{seed}']
 
-    # seeds = [random.randint(0, 10239584) for i in range(num_seeds)]
-    seeds = random_seeds
+# How long to wait for carla_driver to come back to tell it we are done
+ALL_DONE_RECONNECT_TIMEOUT = 60
 
-    # a list of strings which are yamls
-    weathers = ["configs/foggy_day", "configs/rainy_day"] #["configs/clear_day", "configs/clear_night", "configs/clear_sunset", "configs/clear_wet_day", "configs/foggy_day", "configs/rainy_day"] 
+# You do not need to activate the virtual environment as a subprocess because the subprocess will inherit the environment
+def main():
+    random.seed(234905)
 
-    while not os.path.exists("connector.txt"):
-        time.sleep(1)
+    global channel, carla_status
+    channel = ControlChannel.connect()
 
     # before starting collection, check if carla is running
 
@@ -93,35 +139,44 @@ def main():
         for seed in seeds:
             print(f'\n\nStarting a new seed - {seed}\n\n This is seed {seeds.index(seed) + 1}/{len(seeds)} for weather {weathers.index(weather) +1}/{len(weathers)}\n')
 
-            args = ['--weather_config', f'{weather}.yaml', '--random_seed', str(seed),
-                     '--videos_wanted', str(num_videos_per_seed), '--video_images_wait', str(num_images_between_videos),
-                     '--video_images_saved', str(num_images_per_video), '--seconds_per_tick', str(tick_rate), '--video_mode',
-                     '--output_dir', f'/Data/video_data/{weather[8:]}-{seed}']
-            
+            args = collection_args(weather, seed)
 
-            status = -1
-            while status != CARLA_RUNNING:
-                with open("connector.txt", 'r') as f:
-                    status = f.read()
-                time.sleep(1)
+            wait_for_carla()
+            # if carla_driver restarted in between, wait for it to tell us CARLA is up again
+            while not send_flag(COLLECTION_RUNNING):
+                wait_for_carla()
 
             print("carla is running!!")
-            with open("connector.txt", 'w') as f:
-                f.write(COLLECTION_RUNNING)
 
             return_code = 1
 
             while return_code != 0:
                 return_code = run_collection(args)
 
-                with open("connector.txt", 'w') as f:
-                    if return_code != 0: # do not write to file because we're still collectig data
-                        print('Something happened and return code was not 0, so will collect again')
-                        f.write(CARLA_RUNNING)
-                    elif weather == weathers[-1] and seed == seeds[-1]:
-                        f.write(ALL_DONE)
-                    else:
-                        f.write(COLLECTION_COMPLETE)
+                if return_code == SETTINGS_MISMATCH_EXIT_CODE:
+                    # the output dir has a run with other settings, collecting again won't fix that
+                    print(f'Skipping {weather} seed {seed}, its output dir is from a run with different settings')
+                    break
+                elif return_code != 0: # carla_driver keeps CARLA up (or restarts it if it died), we collect again
+                    print('Something happened and return code was not 0, so will collect again')
+                    wait_for_carla()
+
+            if weather == weathers[-1] and seed == seeds[-1]:
+                # carla_driver has to get this one to stop CARLA, unless it is gone for good
+                try:
+                    while not send_flag(ALL_DONE, timeout = ALL_DONE_RECONNECT_TIMEOUT):
+                        pass
+                except (FileNotFoundError, ConnectionRefusedError):
+                    print(f"carla_driver didn't come back within {ALL_DONE_RECONNECT_TIMEOUT} seconds, CARLA may still be running")
+                    return
+            else:
+                # carla_driver tells us when CARLA is ready for the next seed (same server, or restarted if it
+                # was using too much memory). It waits for this after a skipped seed too. If it restarted in the
+                # meantime, the new connection tells us that instead, so there is nothing to send again.
+                send_flag(COLLECTION_COMPLETE)
+                carla_status = CARLA_DOWN
+
+    channel.close()
 
 
 if __name__ == '__main__':
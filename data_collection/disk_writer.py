@@ -0,0 +1,108 @@
+import time
+import threading
+from queue import Queue
+import numpy as np
+from frame_encoding import write_frame
+
+# Writing a 1920x1080 png takes long enough that doing it inside the sensor callback (image.save_to_disk) holds up
+# every synchronous tick. Instead the camera copies the raw BGRA buffer once and hands it to this writer, which encodes
+# and writes it on a few background threads (cv2 releases the GIL while encoding, so threads are enough).
+# The queue is bounded: if the writers fall behind, put() blocks the callback until there is room again, so we can't
+# run out of memory. close() waits for everything that is still queued to be written.
+# encoding and png_compression pick how the frames are stored, see frame_encoding.py
+class DiskWriter():
+    def __init__(self, num_threads: int = 2, max_queue_size: int = 16, name: str = 'writer',
+                 encoding: str = 'png', png_compression: int = None):
+        self.name = name
+        self.encoding = encoding
+        self.png_compression = png_compression
+        self.queue = Queue(maxsize=max_queue_size)
+        self.lock = threading.Lock()
+
+        # Counters, see stats()
+        self.frames_written = 0
+        self.bytes_written = 0
+        self.write_seconds = 0.0 # time spent encoding + writing
+        self.max_write_seconds = 0.0
+        self.latency_seconds = 0.0 # time from put() until the file is on disk
+        self.max_latency_seconds = 0.0
+        self.blocked_seconds = 0.0 # time put() spent waiting on a full queue
+        self.max_queue_depth = 0
+        self.errors = 0
+
+        self.threads = []
+        for i in range(num_threads):
+            thread = threading.Thread(target=self._work, name=f'{name}_{i}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    # image is the raw BGRA camera frame, with the png encoding it is written as is (same as save_to_disk with the
+    # Raw color converter)
+    def put(self, path: str, image: np.ndarray):
+        start = time.perf_counter()
+        self.queue.put((path, image, start))
+        blocked = time.perf_counter() - start
+
+        with self.lock:
+            self.blocked_seconds += blocked
+            self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+
+            path, image, queued_at = item
+            start = time.perf_counter()
+            try:
+                size = write_frame(path, image, self.encoding, self.png_compression)
+            except Exception as e:
+                print(f"{self.name}: error while writing {path}: {e}")
+                with self.lock:
+                    self.errors += 1
+                self.queue.task_done()
+                continue
+
+            end = time.perf_counter()
+            with self.lock:
+                self.frames_written += 1
+                self.bytes_written += size
+                self.write_seconds += end - start
+                self.max_write_seconds = max(self.max_write_seconds, end - start)
+                self.latency_seconds += end - queued_at
+                self.max_latency_seconds = max(self.max_latency_seconds, end - queued_at)
+            self.queue.task_done()
+
+    def queue_depth(self) -> int:
+        return self.queue.qsize()
+
+    # Frames put() that aren't on disk yet (queued or being written)
+    def pending(self) -> int:
+        with self.queue.mutex:
+            return self.queue.unfinished_tasks
+
+    def stats(self) -> dict:
+        with self.lock:
+            written = max(self.frames_written, 1)
+            return {
+                'queue_depth': self.queue.qsize(),
+                'max_queue_depth': self.max_queue_depth,
+                'frames_written': self.frames_written,
+                'bytes_written': self.bytes_written,
+                'errors': self.errors,
+                'mean_write_ms': 1000 * self.write_seconds / written,
+                'max_write_ms': 1000 * self.max_write_seconds,
+                'mean_latency_ms': 1000 * self.latency_seconds / written,
+                'max_latency_ms': 1000 * self.max_latency_seconds,
+                'blocked_ms': 1000 * self.blocked_seconds,
+            }
+
+    # Wait for the queue to drain and stop the threads
+    def close(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
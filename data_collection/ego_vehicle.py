@@ -2,6 +2,7 @@ import carla
 import os
 import numpy as np
 from camera import Camera
+from blueprint_cache import BlueprintCache
 
 # Regarding organization:
 # This should be split into two files: one for the ego vehicle and one for the camera.
@@ -12,13 +13,19 @@ from camera import Camera
 # It also has functions to turn the lights on and off, and to configure the experiment.
 
 class Ego_Vehicle():
-    def __init__(self, world: carla.World, spawn_point = None, blueprint_name: str = 'vehicle.tesla.cybertruck', random_seed = None):
+    def __init__(self, world: carla.World, spawn_point = None, blueprint_name: str = 'vehicle.tesla.cybertruck', random_seed = None,
+                 blueprints: BlueprintCache = None, tm_port: int = 8000):
         self.world = world
+        # the traffic manager that drives us, has to be the world's when several servers run side by side
+        self.tm_port = tm_port
 
         # TODO: let's make the vehicle model a parameter instead of randomly selecting one
         # BUG: related to the above, our hardcoded camera positions do not work for all vehicle models
         # blueprint = np.random.choice(world.get_blueprint_library().filter('vehicle.*.*'))
-        blueprint = world.get_blueprint_library().find(blueprint_name)
+        if blueprints is not None:
+            blueprint = blueprints.find(blueprint_name)
+        else:
+            blueprint = world.get_blueprint_library().find(blueprint_name)
         spawn_points = world.get_map().get_spawn_points()
         if spawn_point is None:
             if random_seed is not None:
@@ -26,11 +33,13 @@ class Ego_Vehicle():
             spawn_point = np.random.choice(spawn_points)
         else:
             spawn_point = spawn_points[spawn_point]
+        # In synchronous mode get_location() is (0, 0, 0) until the world ticks, use this before that
+        self.spawn_point: carla.Transform = spawn_point
         
         self.cameras = []
         
         self.vehicle = world.spawn_actor(blueprint, spawn_point)
-        self.vehicle.set_autopilot(True)
+        self.vehicle.set_autopilot(True, self.tm_port)
         print('created %s' % self.vehicle.type_id)
 
     def add_camera(self, camera: Camera):
@@ -52,10 +61,10 @@ class Ego_Vehicle():
         # current_lights |= carla.VehicleLightState.HighBeam
         current_lights |= carla.VehicleLightState.Position
         self.vehicle.set_light_state(carla.VehicleLightState(current_lights))
-        self.vehicle.set_autopilot(True)
+        self.vehicle.set_autopilot(True, self.tm_port)
 
     def lights_off(self):
         print("turning off lights")
         current_lights = carla.VehicleLightState.NONE
         self.vehicle.set_light_state(carla.VehicleLightState(current_lights))
-        self.vehicle.set_autopilot(True)
\ No newline at end of file
+        self.vehicle.set_autopilot(True, self.tm_port)
\ No newline at end of file
@@ -0,0 +1,70 @@
+import io
+import os
+import numpy as np
+import cv2
+
+# The different ways we can store a camera frame. All of them take the raw BGRA buffer from CARLA.
+#   png          - the full BGRA image as a png (what save_to_disk gives us). png_compression sets the zlib level (0-9)
+#   webp         - the full image as lossless webp
+#   class_png    - only the R channel (the semantic class id) as an 8 bit single channel png. For rgb_seg
+#   instance_png - only the G and B channels (the instance id, G << 8 | B) as a 16 bit single channel png. The class is
+#                  already in rgb_seg. For instance_seg
+#   packed_npy   - R << 16 | G << 8 | B as one uint32 per pixel in a .npy file, the same key vis_data_annotation uses
+#                  for the instances. For instance_seg
+#   npy          - the raw BGRA buffer as a (height, width, 4) uint8 .npy file
+ENCODING_EXTENSIONS = {
+    'png': 'png',
+    'webp': 'webp',
+    'class_png': 'png',
+    'instance_png': 'png',
+    'packed_npy': 'npy',
+    'npy': 'npy',
+}
+
+# Which encodings make sense for which camera
+CAMERA_ENCODINGS = {
+    'sensor.camera.rgb': ['png', 'webp', 'npy'],
+    'sensor.camera.semantic_segmentation': ['png', 'webp', 'class_png', 'npy'],
+    'sensor.camera.instance_segmentation': ['png', 'webp', 'instance_png', 'packed_npy', 'npy'],
+}
+
+def _encode_npy(array: np.ndarray) -> bytes:
+    buffer = io.BytesIO()
+    np.save(buffer, array)
+    return buffer.getvalue()
+
+def _encode_image(extension: str, image: np.ndarray, params = ()) -> bytes:
+    ok, data = cv2.imencode(extension, image, list(params))
+    if not ok:
+        raise IOError(f'cv2 could not encode the frame as {extension}')
+    return data.tobytes()
+
+# image is the (height, width, 4) BGRA frame
+def encode_frame(image: np.ndarray, encoding: str = 'png', png_compression: int = None) -> bytes:
+    png_params = () if png_compression is None else (cv2.IMWRITE_PNG_COMPRESSION, png_compression)
+
+    if encoding == 'png':
+        return _encode_image('.png', image, png_params)
+    elif encoding == 'webp':
+        # quality above 100 means lossless in opencv
+        return _encode_image('.webp', image, (cv2.IMWRITE_WEBP_QUALITY, 101))
+    elif encoding == 'class_png':
+        return _encode_image('.png', np.ascontiguousarray(image[:, :, 2]), png_params)
+    elif encoding == 'instance_png':
+        instance_ids = (image[:, :, 1].astype(np.uint16) << 8) | image[:, :, 0]
+        return _encode_image('.png', instance_ids, png_params)
+    elif encoding == 'packed_npy':
+        packed = (image[:, :, 2].astype(np.uint32) << 16) | (image[:, :, 1].astype(np.uint32) << 8) | image[:, :, 0]
+        return _encode_npy(packed)
+    elif encoding == 'npy':
+        return _encode_npy(image)
+    else:
+        raise ValueError(f'Unknown encoding {encoding}, expected one of {list(ENCODING_EXTENSIONS)}')
+
+# Encode the frame and write it to path, returns the number of bytes written
+def write_frame(path: str, image: np.ndarray, encoding: str = 'png', png_compression: int = None) -> int:
+    data = encode_frame(image, encoding, png_compression)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return len(data)
@@ -0,0 +1,121 @@
+import time
+import threading
+
+# check_has_image used to decide a frame was complete when the last camera's has_new_image flag flipped, then took
+# len(ego.cameras) items off a shared queue (2 seconds timeout each) and assumed cameras[0] was the rgb camera. That falls
+# apart with more cameras (e.g. a surround rig of six cameras and a lidar), when the sensors don't report in order, or
+# when one of them misses a frame.
+#
+# Instead every camera hands what it saved to this synchronizer, which groups them by simulator frame. A bundle is
+# released when every registered sensor reported for its frame, or when deadline seconds passed since the first one
+# did (then the missing sensors count as dropped). It also keeps track of how long after the tick every sensor's data
+# showed up (call tick() with the frame world.tick() returned).
+
+# What a camera saved for one frame, with everything we need to process it later (the camera's *_at_last_image
+# attributes get overwritten by the next frame)
+class SensorFrame():
+    def __init__(self, camera, data, counter: int, path: str, vehicle_locations, vehicle_classes, transform):
+        self.camera = camera
+        self.data = data
+        self.counter = counter
+        self.path = path
+        self.vehicle_locations = vehicle_locations
+        self.vehicle_classes = vehicle_classes
+        self.transform = transform
+
+class FrameBundle():
+    def __init__(self, frame: int, opened: float):
+        self.frame = frame
+        self.opened = opened
+        self.sensors = {} # camera name -> SensorFrame
+        self.missing = []
+
+    @property
+    def complete(self) -> bool:
+        return not self.missing
+
+    # The SensorFrames of the cameras with this blueprint (e.g. 'sensor.camera.rgb'), in the order they were registered
+    def by_blueprint(self, blueprint: str) -> list:
+        return [sensor for sensor in self.sensors.values() if sensor.camera.blueprint == blueprint]
+
+class FrameSynchronizer():
+    def __init__(self, deadline: float = 2.0):
+        self.deadline = deadline
+        self.lock = threading.Lock()
+        self.sensors = [] # camera names in registration order
+        self.open = {} # frame -> FrameBundle
+        self.tick_times = {} # frame -> when world.tick() returned it
+
+        # per sensor stats, see stats()
+        self.received = {}
+        self.dropped = {}
+        self.latency_seconds = {}
+        self.max_latency_seconds = {}
+        self.bundles = 0
+        self.incomplete_bundles = 0
+
+    def register(self, camera):
+        with self.lock:
+            self.sensors.append(camera.name)
+            self.received[camera.name] = 0
+            self.dropped[camera.name] = 0
+            self.latency_seconds[camera.name] = 0.0
+            self.max_latency_seconds[camera.name] = 0.0
+
+    def tick(self, frame: int):
+        with self.lock:
+            self.tick_times[frame] = time.perf_counter()
+
+    # Called from the sensor callbacks
+    def add(self, sensor_frame: SensorFrame):
+        now = time.perf_counter()
+        name = sensor_frame.camera.name
+        frame = sensor_frame.data.frame
+        with self.lock:
+            bundle = self.open.get(frame)
+            if bundle is None:
+                bundle = self.open[frame] = FrameBundle(frame, now)
+            # keep the registration order so cameras[0] style code still finds the same camera first
+            bundle.sensors[name] = sensor_frame
+            bundle.sensors = {sensor: bundle.sensors[sensor] for sensor in self.sensors if sensor in bundle.sensors}
+
+            self.received[name] += 1
+            # the callback can run before tick() got the frame back
+            latency = max(0.0, now - self.tick_times.get(frame, now))
+            self.latency_seconds[name] += latency
+            self.max_latency_seconds[name] = max(self.max_latency_seconds[name], latency)
+
+    # The bundles that are ready (all sensors in or past the deadline), oldest first. flush releases everything.
+    def pop_ready(self, flush: bool = False) -> list:
+        now = time.perf_counter()
+        ready = []
+        with self.lock:
+            for frame in sorted(self.open):
+                bundle = self.open[frame]
+                if len(bundle.sensors) == len(self.sensors) or flush or now - bundle.opened > self.deadline:
+                    bundle.missing = [sensor for sensor in self.sensors if sensor not in bundle.sensors]
+                    for sensor in bundle.missing:
+                        self.dropped[sensor] += 1
+                    self.bundles += 1
+                    self.incomplete_bundles += not bundle.complete
+                    del self.open[frame]
+                    ready.append(bundle)
+
+            # nobody needs the tick times of the frames before the oldest open one
+            oldest = min(self.open) if self.open else (ready[-1].frame if ready else None)
+            if oldest is not None:
+                for frame in [frame for frame in self.tick_times if frame < oldest]:
+                    del self.tick_times[frame]
+        return ready
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'bundles': self.bundles,
+                'incomplete_bundles': self.incomplete_bundles,
+                'sensors': {name: {'received': self.received[name],
+                                   'dropped': self.dropped[name],
+                                   'mean_latency_ms': 1000 * self.latency_seconds[name] / max(self.received[name], 1),
+                                   'max_latency_ms': 1000 * self.max_latency_seconds[name]}
+                            for name in self.sensors},
+            }
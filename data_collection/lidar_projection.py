@@ -13,6 +13,7 @@ Lidar projection on RGB camera example
 import glob
 import os
 import sys
+import time
 
 try:
     sys.path.append(glob.glob('../carla/dist/carla-*%d.%d-%s.egg' % (
@@ -26,6 +27,7 @@ import carla
 
 from queue import Queue
 from queue import Empty
+from calibration import SensorCalibration
 
 try:
     import numpy as np
@@ -42,121 +44,142 @@ def get_distances(p_cloud):
     distances = np.linalg.norm(coordinates, axis=1)
     return distances
 
-def project(image_data, lidar_data, camera: carla.Actor, camera_bp: carla.ActorBlueprint, lidar: carla.Actor, 
-            camera_transform: carla.Transform, lidar_transform: carla.Transform):
-    # Build the K projection matrix:
-    # K = [[Fx,  0, image_w/2],
-    #      [ 0, Fy, image_h/2],
-    #      [ 0,  0,         1]]
-    image_w = camera_bp.get_attribute("image_size_x").as_int()
-    image_h = camera_bp.get_attribute("image_size_y").as_int()
-    fov = camera_bp.get_attribute("fov").as_float()
-    focal = image_w / (2.0 * np.tan(fov * np.pi / 360.0))
-
-    # In this case Fx and Fy are the same since the pixel aspect
-    # ratio is 1
-    K = np.identity(3)
-    K[0, 0] = K[1, 1] = focal
-    K[0, 2] = image_w / 2.0
-    K[1, 2] = image_h / 2.0
-
-    # Get the raw BGRA buffer and convert it to an array of RGB of
-    # shape (image_data.height, image_data.width, 3).
-    im_array = np.copy(np.frombuffer(image_data.raw_data, dtype=np.dtype("uint8")))
-    im_array = np.reshape(im_array, (image_data.height, image_data.width, 4))
-    im_array = im_array[:, :, :3][:, :, ::-1]
-
-    # Get the lidar data and convert it to a numpy array.
-    p_cloud_size = len(lidar_data)
-    p_cloud = np.copy(np.frombuffer(lidar_data.raw_data, dtype=np.dtype('f4')))
-    p_cloud = np.reshape(p_cloud, (p_cloud_size, 4))
-
-    # Lidar intensity array of shape (p_cloud_size,) but, for now, let's
-    # focus on the 3D points.
-    intensity = np.array(p_cloud[:, 3])
-    distance = get_distances(p_cloud)
-
-    assert intensity.shape == distance.shape
-
-    # Point cloud in lidar sensor space array of shape (3, p_cloud_size).
-    local_lidar_points = np.array(p_cloud[:, :3]).T
-
-    # Add an extra 1.0 at the end of each 3d point so it becomes of
-    # shape (4, p_cloud_size) and it can be multiplied by a (4, 4) matrix.
-    local_lidar_points = np.r_[
-        local_lidar_points, [np.ones(local_lidar_points.shape[1])]]
-
-    # This (4, 4) matrix transforms the points from lidar space to world space.
-    # lidar_2_world = lidar.get_transform().get_matrix()
-    lidar_2_world = camera.get_transform().get_matrix()
-    # lidar_2_world = lidar_transform.get_matrix()
-
-    # Transform the points from lidar space to world space.
-    world_points = np.dot(lidar_2_world, local_lidar_points)
-
-    # This (4, 4) matrix transforms the points from world to sensor coordinates.
-    world_2_camera = np.array(camera.get_transform().get_inverse_matrix())
-    # world_2_camera = np.array(camera_transform.get_inverse_matrix())
-
-    # Transform the points from world space to camera space.
-    sensor_points = np.dot(world_2_camera, world_points)
-
-    # New we must change from UE4's coordinate system to an "standard"
-    # camera coordinate system (the same used by OpenCV):
-
-    # ^ z                       . z
-    # |                        /
-    # |              to:      +-------> x
-    # | . x                   |
-    # |/                      |
-    # +-------> y             v y
-
-    # This can be achieved by multiplying by the following matrix:
-    # [[ 0,  1,  0 ],
-    #  [ 0,  0, -1 ],
-    #  [ 1,  0,  0 ]]
-
-    # Or, in this case, is the same as swapping:
-    # (x, y ,z) -> (y, -z, x)
-    point_in_camera_coords = np.array([
-        sensor_points[1],
-        sensor_points[2] * -1,
-        sensor_points[0]])
-
-    # Finally we can use our K matrix to do the actual 3D -> 2D.
-    points_2d = np.dot(K, point_in_camera_coords)
-
-    # Remember to normalize the x, y values by the 3rd value.
-    points_2d = np.array([
-        points_2d[0, :] / points_2d[2, :],
-        points_2d[1, :] / points_2d[2, :],
-        points_2d[2, :]])
-
-    # At this point, points_2d[0, :] contains all the x and points_2d[1, :]
-    # contains all the y values of our points. In order to properly
-    # visualize everything on a screen, the points that are out of the screen
-    # must be discarted, the same with points behind the camera projection plane.
-    points_2d = points_2d.T
-
-    intensity = intensity.T
-    distance = distance.T
-    points_in_canvas_mask = \
-        (points_2d[:, 0] > 0.0) & (points_2d[:, 0] < image_w) & \
-        (points_2d[:, 1] > 0.0) & (points_2d[:, 1] < image_h) & \
-        (points_2d[:, 2] > 0.0)
-    points_2d = points_2d[points_in_canvas_mask]
-    intensity = intensity[points_in_canvas_mask]
-    distance = distance[points_in_canvas_mask]
-
-    # Extract the screen coords (uv) as integers.
-    u_coord = points_2d[:, 0].astype(np.int)
-    v_coord = points_2d[:, 1].astype(np.int)
-
-    # Since at the time of the creation of this script, the intensity function
-    # is returning high values, these are adjusted to be nicely visualized.
-    intensity = 4 * intensity - 3
-
-
-    lidar_data_array = np.stack((v_coord, u_coord, intensity, distance), axis=0)
-
-    return lidar_data_array
+# The UE4 -> "standard" camera coordinate system (the same used by OpenCV) swap:
+
+# ^ z                       . z
+# |                        /
+# |              to:      +-------> x
+# | . x                   |
+# |/                      |
+# +-------> y             v y
+
+# (x, y ,z) -> (y, -z, x)
+UE4_TO_CAMERA = np.array([[0, 1, 0],
+                          [0, 0, -1],
+                          [1, 0, 0]], dtype=np.float64)
+
+# project used to copy the camera frame (which it never used), copy the point cloud, add a row of ones with np.r_ and
+# go through a few float64 (3, N)/(4, N) arrays per step. With ~100k points per frame that was mostly allocating.
+# This folds lidar space -> camera space -> standard axes -> K into one (3, 4) float32 matrix, works on a view of the
+# lidar buffer, writes into buffers that are kept between frames, and filters the points with one mask.
+# It keeps track of how long every frame takes (last_ms, stats()).
+class LidarProjector():
+    def __init__(self, K: np.ndarray, image_w: int, image_h: int, lidar_2_camera: np.ndarray, max_points: int = 200000):
+        self.P = (K @ UE4_TO_CAMERA @ lidar_2_camera[:3, :]).astype(np.float32)
+        self.image_w = image_w
+        self.image_h = image_h
+        self._allocate(max_points)
+
+        self.frames = 0
+        self.last_ms = 0.0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    @staticmethod
+    def from_calibration(camera_calibration: SensorCalibration, lidar_calibration: SensorCalibration):
+        return LidarProjector(camera_calibration.K, camera_calibration.image_w, camera_calibration.image_h,
+                              lidar_calibration.sensor_to_sensor(camera_calibration))
+
+    def _allocate(self, max_points: int):
+        self.max_points = max_points
+        self.projected = np.empty((max_points, 3), dtype=np.float32)
+        self.mask = np.empty(max_points, dtype=bool)
+        self.scratch = np.empty(max_points, dtype=bool)
+
+    # points is an (N, 4) float32 array of x, y, z, intensity in lidar space. Returns a (4, M) float32 array of
+    # (v, u, intensity, distance) for the points that land on the image, like project always did.
+    def project_points(self, points: np.ndarray) -> np.ndarray:
+        start = time.perf_counter()
+        n = len(points)
+        if n > self.max_points:
+            self._allocate(max(n, 2 * self.max_points))
+        projected = self.projected[:n]
+        mask = self.mask[:n]
+        scratch = self.scratch[:n]
+
+        np.matmul(points[:, :3], self.P[:, :3].T, out=projected)
+        projected += self.P[:, 3]
+
+        # Normalize the x, y values by the 3rd value (points behind the camera divide by <= 0, the mask drops them)
+        depth = projected[:, 2]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.divide(projected[:, 0], depth, out=projected[:, 0])
+            np.divide(projected[:, 1], depth, out=projected[:, 1])
+
+        # The points that are out of the screen or behind the camera projection plane are discarded
+        np.greater(depth, 0.0, out=mask)
+        np.greater(projected[:, 0], 0.0, out=scratch)
+        mask &= scratch
+        np.less(projected[:, 0], self.image_w, out=scratch)
+        mask &= scratch
+        np.greater(projected[:, 1], 0.0, out=scratch)
+        mask &= scratch
+        np.less(projected[:, 1], self.image_h, out=scratch)
+        mask &= scratch
+        index = np.flatnonzero(mask)
+
+        lidar_data_array = np.empty((4, len(index)), dtype=np.float32)
+        # The screen coords (uv) as integers (they are all positive, so trunc is the same as the old astype)
+        np.trunc(projected[index, 1], out=lidar_data_array[0])
+        np.trunc(projected[index, 0], out=lidar_data_array[1])
+
+        kept = points[index]
+        # Since at the time of the creation of this script, the intensity function
+        # is returning high values, these are adjusted to be nicely visualized.
+        np.multiply(kept[:, 3], 4, out=lidar_data_array[2])
+        lidar_data_array[2] -= 3
+        # distance from the lidar
+        np.sqrt(np.einsum('ij,ij->i', kept[:, :3], kept[:, :3]), out=lidar_data_array[3])
+
+        self.last_ms = 1000 * (time.perf_counter() - start)
+        self.frames += 1
+        self.total_ms += self.last_ms
+        self.max_ms = max(self.max_ms, self.last_ms)
+        return lidar_data_array
+
+    def stats(self) -> dict:
+        return {'frames': self.frames, 'mean_ms': self.total_ms / max(self.frames, 1), 'max_ms': self.max_ms}
+
+# lidar_2d is a list of points, several of which can land on the same pixel. This turns it into a z-buffered depth image
+# and an intensity image at camera resolution: every pixel gets the distance and intensity of the nearest point that
+# landed on it, 0 where no point did. Sorting by (pixel, distance) and taking the first point of every pixel does the
+# scatter-min for all of them at once. float16 keeps ~0.1m precision at the 250m lidar range.
+def dense_maps(lidar_2d: np.ndarray, image_w: int, image_h: int):
+    pixels = lidar_2d[0].astype(np.intp) * image_w + lidar_2d[1].astype(np.intp)
+    order = np.lexsort((lidar_2d[3], pixels))
+    sorted_pixels = pixels[order]
+    first = np.ones(len(order), dtype=bool)
+    np.not_equal(sorted_pixels[1:], sorted_pixels[:-1], out=first[1:])
+    nearest = order[first]
+
+    depth = np.zeros(image_h * image_w, dtype=np.float16)
+    intensity = np.zeros(image_h * image_w, dtype=np.float16)
+    depth[pixels[nearest]] = lidar_2d[3, nearest]
+    intensity[pixels[nearest]] = lidar_2d[2, nearest]
+    return depth.reshape(image_h, image_w), intensity.reshape(image_h, image_w)
+
+# Saves the dense_maps. 'npz' is a compressed .npz with depth and intensity (small, but has to be decompressed to read),
+# 'npy' is a (2, H, W) .npy with depth and intensity stacked that np.load(..., mmap_mode='r') can map without reading it.
+def save_dense_maps(path: str, depth: np.ndarray, intensity: np.ndarray, format: str = 'npz'):
+    if format == 'npz':
+        np.savez_compressed(path + '.npz', depth=depth, intensity=intensity)
+    elif format == 'npy':
+        np.save(path + '.npy', np.stack([depth, intensity]))
+    else:
+        raise ValueError(f'Unknown dense lidar format {format}')
+
+# One projector per camera/lidar pair, so the buffers are reused from frame to frame
+_projectors = {}
+
+def get_projector(camera_calibration: SensorCalibration, lidar_calibration: SensorCalibration) -> LidarProjector:
+    key = (id(camera_calibration), id(lidar_calibration))
+    if key not in _projectors:
+        _projectors[key] = LidarProjector.from_calibration(camera_calibration, lidar_calibration)
+    return _projectors[key]
+
+# image_data isn't needed anymore, it is still here so the callers don't have to change. The result is float32 now
+# (it used to be float64, the values are the same up to float32 rounding).
+def project(image_data, lidar_data, camera_calibration: SensorCalibration, lidar_calibration: SensorCalibration):
+    # A view of the lidar buffer, no copy: (N, 4) x, y, z, intensity
+    p_cloud = np.frombuffer(lidar_data.raw_data, dtype=np.float32).reshape(-1, 4)
+    return get_projector(camera_calibration, lidar_calibration).project_points(p_cloud)
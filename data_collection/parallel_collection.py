@@ -0,0 +1,212 @@
+import os
+import sys
+import json
+import time
+import queue
+import signal
+import argparse
+import threading
+import subprocess
+from carla_driver import run_carla, kill_carla, carla_ready, carla_memory_gb
+from data_collection_driver import collection_args, weathers, seeds
+from carla_flags import SETTINGS_MISMATCH_EXIT_CODE
+
+# carla_driver.py + data_collection_driver.py run every (weather, seed) one after the other against one CARLA on
+# localhost:2000. This runs N CARLA servers side by side instead, each on its own RPC port (and streaming ports right
+# after it, hence the port stride) and traffic manager port, with one worker thread per server taking (weather, seed)
+# runs from a shared queue and running data_collection.py against its server. Finished runs are appended to a manifest
+# so starting this again only does the runs that are missing. Run it from this folder, in an environment with both
+# carla and psutil:
+#
+#   python3 parallel_collection.py --servers 3 --gpus 0,1,2
+
+# One line of json per finished run. A crash can leave half a line at the end, we skip those.
+class CompletionManifest():
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.completed = set()
+
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        run = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.completed.add((run['weather'], str(run['seed'])))
+            # so the next line doesn't get glued to a half written one
+            with open(path, 'rb+') as f:
+                f.seek(0, os.SEEK_END)
+                if f.tell() > 0:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        f.write(b'\n')
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def is_done(self, weather: str, seed) -> bool:
+        return (weather, str(seed)) in self.completed
+
+    def mark_done(self, weather: str, seed, **info):
+        with self.lock:
+            self.completed.add((weather, str(seed)))
+            with open(self.path, 'a') as f:
+                f.write(json.dumps({'weather': weather, 'seed': str(seed), 'finished': time.time(), **info}) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+class CarlaServer():
+    def __init__(self, index: int, host: str, port: int, tm_port: int, gpu: str = None, startup_timeout: float = 180,
+                 kill_timeout: float = 30, max_memory_growth: float = 4.0):
+        self.index = index
+        self.host = host
+        self.port = port
+        self.tm_port = tm_port
+        self.gpu = gpu
+        self.startup_timeout = startup_timeout
+        self.kill_timeout = kill_timeout
+        self.max_memory_growth = max_memory_growth
+        self.process = None
+        self.pid = None
+        self.baseline_memory = None
+
+    def start(self):
+        args = ['-prefernvidia', '-RenderOffScreen']
+        if self.gpu is not None:
+            args.append(f'-graphicsadapter={self.gpu}')
+        self.process, self.pid = run_carla(args, host = self.host, port = self.port, startup_timeout = self.startup_timeout,
+                                           kill_timeout = self.kill_timeout, all_carla = False)
+        self.baseline_memory = None
+
+    def stop(self):
+        if self.pid is not None:
+            kill_carla(self.pid, host = self.host, port = self.port, kill_timeout = self.kill_timeout, all_carla = False)
+            self.pid = None
+
+    def restart(self):
+        self.stop()
+        print(f"[server {self.index}] Restarting CARLA")
+        self.start()
+
+    # After a run: restart if CARLA crashed or has been leaking memory (same rule as carla_driver.py)
+    def check(self):
+        if self.process.poll() is not None or not carla_ready(self.host, self.port):
+            print(f"[server {self.index}] CARLA is down")
+            self.restart()
+            return
+
+        memory = carla_memory_gb(self.pid)
+        if self.baseline_memory is None:
+            self.baseline_memory = memory
+        if memory - self.baseline_memory > self.max_memory_growth:
+            print(f"[server {self.index}] CARLA grew by {memory - self.baseline_memory:.2f}GB")
+            self.restart()
+
+def worker(server: CarlaServer, jobs: queue.Queue, manifest: CompletionManifest, max_attempts: int, failed: list,
+           log_dir: str = None):
+    server.start()
+    while True:
+        try:
+            weather, seed, attempt = jobs.get_nowait()
+        except queue.Empty:
+            break
+
+        args = collection_args(weather, seed) + ['--host', server.host, '--port', str(server.port),
+                                                 '--tm_port', str(server.tm_port)]
+        print(f"[server {server.index}] Starting {weather} seed {seed} (attempt {attempt}/{max_attempts}, "
+              f"{jobs.qsize()} runs waiting)")
+        start = time.monotonic()
+
+        log = None
+        if log_dir is not None:
+            log = open(os.path.join(log_dir, f'{weather[8:]}-{seed}.log'), 'a')
+        try:
+            return_code = subprocess.call(['python3', 'data_collection.py', *args], stdout = log, stderr = log)
+        finally:
+            if log is not None:
+                log.close()
+
+        seconds = time.monotonic() - start
+        if return_code == 0:
+            manifest.mark_done(weather, seed, server = server.index, seconds = seconds)
+            print(f"[server {server.index}] Finished {weather} seed {seed} in {seconds:.0f}s")
+        elif return_code == SETTINGS_MISMATCH_EXIT_CODE:
+            print(f"[server {server.index}] {weather} seed {seed}: the output dir is from a run with different settings, "
+                  f"giving up on it")
+            failed.append((weather, seed))
+        elif attempt < max_attempts:
+            print(f"[server {server.index}] {weather} seed {seed} failed with {return_code}, putting it back in the queue")
+            jobs.put((weather, seed, attempt + 1))
+        else:
+            print(f"[server {server.index}] {weather} seed {seed} failed {max_attempts} times, giving up on it")
+            failed.append((weather, seed))
+
+        server.check()
+    server.stop()
+
+def main():
+    argparser = argparse.ArgumentParser(description='Runs the data collection on several CARLA servers at once')
+    argparser.add_argument('--servers', default=2, type=int, help='Number of CARLA servers (default: 2)')
+    argparser.add_argument('--host', default='localhost', help='Where the servers answer (default: localhost)')
+    argparser.add_argument('--port', default=2000, type=int, help='RPC port of the first server (default: 2000)')
+    argparser.add_argument('--tm_port', default=8000, type=int, help='Traffic manager port of the first server (default: 8000)')
+    argparser.add_argument('--port_stride', default=10, type=int,
+                           help='How far apart the ports of two servers are, CARLA also uses the 2 ports after the RPC port (default: 10)')
+    argparser.add_argument('--gpus', default=None, type=str, help='Comma separated GPUs to spread the servers over (default: CARLA picks)')
+    argparser.add_argument('--manifest', default='/Data/video_data/completed.jsonl', type=str,
+                           help='Where the finished runs are recorded (default: /Data/video_data/completed.jsonl)')
+    argparser.add_argument('--max_attempts', default=3, type=int, help='How many times to try a run before giving up on it (default: 3)')
+    argparser.add_argument('--startup_timeout', default=180, type=float, help='Seconds to wait for a CARLA to answer (default: 180)')
+    argparser.add_argument('--kill_timeout', default=30, type=float, help='Seconds to wait for a CARLA to exit (default: 30)')
+    argparser.add_argument('--max_memory_growth', default=4.0, type=float,
+                           help='Restart a CARLA once its memory grew by this many GB since its first run (default: 4)')
+    argparser.add_argument('--log_dir', default=None, type=str, help='Write the output of every run here instead of to the terminal')
+    args = argparser.parse_args()
+
+    if args.port_stride < 3:
+        raise ValueError('--port_stride has to be at least 3')
+    if args.log_dir is not None:
+        os.makedirs(args.log_dir, exist_ok=True)
+
+    manifest = CompletionManifest(args.manifest)
+    jobs = queue.Queue()
+    for weather in weathers:
+        for seed in seeds:
+            if not manifest.is_done(weather, seed):
+                jobs.put((weather, seed, 1))
+    total = len(weathers) * len(seeds)
+    print(f"{total - jobs.qsize()}/{total} runs already done, {jobs.qsize()} to go on {args.servers} servers")
+
+    gpus = args.gpus.split(',') if args.gpus else None
+    servers = [CarlaServer(i, args.host, args.port + i * args.port_stride, args.tm_port + i * args.port_stride,
+                           gpu = gpus[i % len(gpus)] if gpus else None, startup_timeout = args.startup_timeout,
+                           kill_timeout = args.kill_timeout, max_memory_growth = args.max_memory_growth)
+               for i in range(min(args.servers, jobs.qsize()))]
+
+    # This is if someone hits Ctrl + C, don't leave the servers running
+    def signal_handler(sig, frame):
+        print("\nReceived termination signal (Ctrl+C) for parallel collection, killing the CARLA servers")
+        for server in servers:
+            server.stop()
+        sys.exit(0)
+    signal.signal(signal.SIGINT, signal_handler)
+
+    failed = []
+    start = time.monotonic()
+    threads = [threading.Thread(target = worker, args = (server, jobs, manifest, args.max_attempts, failed, args.log_dir),
+                                daemon = True) for server in servers]
+    for thread in threads:
+        thread.start()
+    # join with a timeout so Ctrl + C still gets through
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(1)
+
+    hours = (time.monotonic() - start) / 3600
+    print(f"\nDone in {hours:.2f}h, {len(manifest.completed)}/{total} runs finished")
+    if failed:
+        print(f"These runs failed {args.max_attempts} times: {failed}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+import os
+import json
+import time
+
+# When data_collection.py crashed, the drivers used to run the exact same command again, which started over from frame 0
+# and wrote over what we already had. Now every run keeps manifest.jsonl in its output dir, one json object per line:
+#   {"event": "start", "run": {...}}                          every time the run (re)starts, with the settings that matter
+#   {"event": "video", "video": 3, "frames": {"rgb": 232}}    once all the cameras have the first 4 videos on disk
+#   {"event": "done", "frames": {...}}                        the run finished
+# A run that is done is skipped. In video mode a run that crashed starts again from the beginning of the seed (the
+# simulation has to be replayed to get the same traffic) but the cameras don't save anything until the first video
+# that isn't finished, and the VideoSensorScheduler sleeps them through the finished ones like through any other wait.
+# The manifest in the output dir is from a run with different settings
+class RunSettingsMismatch(ValueError):
+    pass
+
+class RunManifest():
+    def __init__(self, out_dir: str, run: dict, resume: bool = True):
+        self.path = os.path.join(out_dir, 'manifest.jsonl')
+        self.run = run
+        self.videos_done = 0
+        self.run_done = False
+
+        if resume and os.path.exists(self.path):
+            self._load()
+        elif os.path.exists(self.path):
+            os.remove(self.path)
+
+        self._append({'event': 'start', 'run': run})
+
+    def _load(self):
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # half written when we crashed
+                    continue
+
+                if entry['event'] == 'start' and entry['run'] != self.run:
+                    raise RunSettingsMismatch(f'{self.path} is from a run with different settings ({entry["run"]}), '
+                                     f'use another output dir or --no_resume')
+                elif entry['event'] == 'video':
+                    self.videos_done = max(self.videos_done, entry['video'] + 1)
+                elif entry['event'] == 'done':
+                    self.run_done = True
+
+        if self.videos_done > 0 and not self.run_done:
+            print(f"Resuming from {self.path}: {self.videos_done} videos are already done")
+
+    def _append(self, entry: dict):
+        entry['time'] = time.time()
+        # the newline first, in case the last line was cut off by a crash
+        with open(self.path, 'a') as f:
+            if f.tell() > 0:
+                f.write('\n')
+            f.write(json.dumps(entry))
+            f.flush()
+            os.fsync(f.fileno())
+
+    # The camera counter to start saving at
+    def resume_counter(self, video_images_saved: int, video_images_wait: int) -> int:
+        return self.videos_done * (video_images_saved + video_images_wait)
+
+    # Call this every tick, records the videos that all the video mode cameras have on disk
+    def update(self, cameras: list):
+        cameras = [camera for camera in cameras if camera.video_mode]
+        if not cameras:
+            return
+
+        done = [camera.videos_on_disk() for camera in cameras]
+        if None in done:
+            return
+        while self.videos_done < min(done):
+            self._append({'event': 'video', 'video': self.videos_done,
+                          'frames': {camera.name: camera.counter for camera in cameras}})
+            self.videos_done += 1
+
+    # Call this once the cameras are destroyed (so the writers are flushed) and the run is complete
+    def finish(self, cameras: list):
+        self.update(cameras)
+        self._append({'event': 'done', 'frames': {camera.name: camera.counter for camera in cameras}})
+        self.run_done = True
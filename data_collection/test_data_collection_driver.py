@@ -0,0 +1,85 @@
+import threading
+import data_collection_driver as driver
+from carla_flags import CARLA_RUNNING, COLLECTION_RUNNING, COLLECTION_COMPLETE, ALL_DONE, SETTINGS_MISMATCH_EXIT_CODE
+from control_channel import ControlChannel
+
+# A fake carla_driver that hangs up in the middle of the first run, like when it restarts, then takes the driver back
+def fake_carla_driver(hung_up: threading.Event, received: list):
+    channel, listener = ControlChannel.listen()
+    channel.send(CARLA_RUNNING)
+    received.append(channel.recv(timeout = 5))
+    channel.close()
+    hung_up.set()
+
+    channel, listener = ControlChannel.listen(listener = listener)
+    channel.send(CARLA_RUNNING)
+    while True:
+        message = channel.recv(timeout = 5)
+        received.append(message)
+        if message == ALL_DONE:
+            break
+        if message == COLLECTION_COMPLETE:
+            channel.send(CARLA_RUNNING)
+    channel.close()
+    listener.close()
+
+def test_driver_survives_dropped_channel(tmp_path, monkeypatch):
+    # the socket goes to the current dir
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(driver, 'weathers', ['configs/clear_day'])
+    monkeypatch.setattr(driver, 'seeds', ['1', '2'])
+    monkeypatch.setattr(driver, 'carla_status', driver.CARLA_DOWN)
+
+    hung_up = threading.Event()
+    received = []
+    peer = threading.Thread(target=fake_carla_driver, args=(hung_up, received), daemon=True)
+    peer.start()
+
+    runs = []
+    def run_collection(args):
+        # carla_driver goes away while we collect, the COLLECTION_COMPLETE after this run gets lost
+        assert hung_up.wait(5)
+        runs.append(args)
+        return 0
+    monkeypatch.setattr(driver, 'run_collection', run_collection)
+
+    driver.main()
+    peer.join(5)
+
+    assert not peer.is_alive()
+    assert len(runs) == 2
+    assert received == [COLLECTION_RUNNING, COLLECTION_RUNNING, ALL_DONE]
+
+# A fake carla_driver that answers every COLLECTION_COMPLETE like the real one
+def fake_carla_driver_answering(received: list):
+    channel, listener = ControlChannel.listen()
+    channel.send(CARLA_RUNNING)
+    while True:
+        message = channel.recv(timeout = 5)
+        received.append(message)
+        if message == ALL_DONE:
+            break
+        if message == COLLECTION_COMPLETE:
+            channel.send(CARLA_RUNNING)
+    channel.close()
+    listener.close()
+
+def test_skipped_seed_still_completes(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(driver, 'weathers', ['configs/clear_day'])
+    monkeypatch.setattr(driver, 'seeds', ['1', '2'])
+    monkeypatch.setattr(driver, 'carla_status', driver.CARLA_DOWN)
+
+    received = []
+    peer = threading.Thread(target=fake_carla_driver_answering, args=(received,), daemon=True)
+    peer.start()
+
+    # the first seed's output dir is from a run with other settings
+    return_codes = [SETTINGS_MISMATCH_EXIT_CODE, 0]
+    monkeypatch.setattr(driver, 'run_collection', lambda args: return_codes.pop(0))
+
+    driver.main()
+    peer.join(5)
+
+    assert not peer.is_alive()
+    assert received == [COLLECTION_RUNNING, COLLECTION_COMPLETE, COLLECTION_RUNNING, ALL_DONE]
@@ -0,0 +1,156 @@
+import os
+import csv
+import json
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+import numpy as np
+
+# Parquet is optional, we fall back to the csv without pandas
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+# Where the time of the data_collection.py main loop goes, per simulator frame. With --profile the main loop wraps its
+# phases (world.tick, check_next_weather, check_dead, check_has_image, lidar projection, ...) in profiler.phase(...) and
+# the sensor callbacks report their own time (callback_<sensor> for the whole callback, save_<sensor> for writing to
+# disk or handing the image to the DiskWriter). At the end we write
+#   profile.csv (or profile.parquet)  one row per frame, one column per phase, in ms. loop is the whole iteration.
+#   profile_trace.json                every phase as a Chrome trace event, open it in chrome://tracing or ui.perfetto.dev
+# and print FPS, p50/p95 of the loop and world.tick and the bytes every sensor wrote.
+# The phases can nest (lidar_projection is part of check_has_image), and the callbacks run on CARLA's threads while
+# world.tick() waits for them, so the columns don't add up to loop.
+#
+# The rows are keyed by frame: the main loop phases go to the latest frame world.tick() returned (the one we are
+# processing), the sensor callbacks to the frame of their data. The trace is written as we go, so a crashed run still
+# has one (Chrome doesn't need the closing bracket).
+# Without --profile every call is a no-op.
+class TickProfiler():
+    def __init__(self, out_dir: str = None, parquet: bool = False):
+        self.enabled = out_dir is not None
+        self.out_dir = out_dir
+        self.parquet = parquet
+        self.lock = threading.Lock()
+
+        self.frame = None
+        self.rows = {} # frame -> {phase: ms}
+        self.phases = [] # in the order we first saw them, for the columns
+        self.sensor_bytes = {}
+        self.loop_start = None
+        self.run_start = None
+        self.ticks = 0
+
+        self.trace = None
+        self.trace_threads = set()
+        self.start = time.perf_counter()
+        if self.enabled:
+            self.trace = open(os.path.join(out_dir, 'profile_trace.json'), 'w')
+            self.trace.write('[')
+            self.trace_empty = True
+
+    # with profiler.phase('check_dead'): ...
+    def phase(self, name: str, frame: int = None):
+        if not self.enabled:
+            return nullcontext()
+        return self._phase(name, frame)
+
+    @contextmanager
+    def _phase(self, name, frame):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter(), frame)
+
+    # For the sensor callbacks, which time themselves. start/end are time.perf_counter()
+    def record(self, name: str, start: float, end: float, frame: int = None):
+        if not self.enabled:
+            return
+        thread = threading.current_thread()
+        with self.lock:
+            frame = self.frame if frame is None else frame
+            row = self.rows.setdefault(frame, {})
+            row[name] = row.get(name, 0.0) + 1000 * (end - start)
+            if name not in self.phases:
+                self.phases.append(name)
+
+            if thread.ident not in self.trace_threads:
+                self.trace_threads.add(thread.ident)
+                self._trace_event({'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': thread.ident,
+                                   'args': {'name': thread.name}})
+            self._trace_event({'name': name, 'ph': 'X', 'pid': 0, 'tid': thread.ident,
+                               'ts': 1e6 * (start - self.start), 'dur': 1e6 * (end - start), 'args': {'frame': frame}})
+
+    def _trace_event(self, event: dict):
+        self.trace.write(('\n' if self.trace_empty else ',\n') + json.dumps(event))
+        self.trace_empty = False
+
+    # Call with the frame world.tick() returned, closes the loop iteration of the frame before
+    def next_frame(self, frame: int):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self.loop_start is not None:
+            self.record('loop', self.loop_start, now)
+            self.ticks += 1
+        else:
+            self.run_start = now
+        with self.lock:
+            self.frame = frame
+        self.loop_start = now
+
+    # Bytes a sensor wrote outside of a DiskWriter (those count their own)
+    def add_bytes(self, sensor: str, size: int):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.sensor_bytes[sensor] = self.sensor_bytes.get(sensor, 0) + size
+
+    def _write_table(self) -> str:
+        columns = ['frame'] + self.phases
+        frames = sorted(frame for frame in self.rows if frame is not None)
+        if self.parquet and pd is not None:
+            path = os.path.join(self.out_dir, 'profile.parquet')
+            table = pd.DataFrame([[frame] + [self.rows[frame].get(phase, np.nan) for phase in self.phases]
+                                  for frame in frames], columns=columns)
+            try:
+                table.to_parquet(path, index=False)
+                return path
+            except ImportError as e:
+                print(f"Can't write parquet ({e}), writing csv instead")
+        elif self.parquet:
+            print("Can't write parquet without pandas, writing csv instead")
+
+        path = os.path.join(self.out_dir, 'profile.csv')
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for frame in frames:
+                writer.writerow([frame] + [f'{self.rows[frame][phase]:.3f}' if phase in self.rows[frame] else ''
+                                           for phase in self.phases])
+        return path
+
+    # Call once the cameras are destroyed, so their writers are done
+    def close(self, cameras: list):
+        if not self.enabled:
+            return
+        with self.lock:
+            # a late callback can't write to the closed trace
+            self.enabled = False
+            self.trace.write('\n]\n')
+            self.trace.close()
+            path = self._write_table()
+
+        print(f"Profile of {self.ticks} ticks written to {path} and {self.trace.name}")
+        if self.ticks > 0:
+            print(f"    {self.ticks / (self.loop_start - self.run_start):.2f} FPS")
+        for phase in ['loop', 'world.tick']:
+            times = [row[phase] for row in self.rows.values() if phase in row]
+            if times:
+                print(f"    {phase}: p50 {np.percentile(times, 50):.1f}ms, p95 {np.percentile(times, 95):.1f}ms")
+        for camera in cameras:
+            size = self.sensor_bytes.get(camera.name, 0)
+            if camera.writer is not None:
+                size += camera.writer.stats()['bytes_written']
+            print(f"    {camera.name}: {size / 2**20:.1f}MB written")
@@ -1,11 +1,12 @@
-from queue import Queue, Empty
 from world import World
 from ego_vehicle import Ego_Vehicle
+from frame_sync import FrameSynchronizer
+from tick_profiler import TickProfiler
 import time
 import os
 import cv2
 import bounding_boxes as bb
-from lidar_projection import project
+from lidar_projection import project, dense_maps, save_dense_maps
 import numpy as np
 
 def quantize_to_tick(seconds_per_tick: int, world_delta_seconds: int) -> int:
@@ -49,51 +50,56 @@ def check_dead(cur_image_num: int, check_for_dead: bool, world: World, interval:
         return False
     return check_for_dead
 
-def check_has_image(ego: Ego_Vehicle, sensor_queue: Queue, world: World, debug: bool, draw_bounding_box: bool, out_dir: str) -> None:
-    if ego.cameras[-1].has_new_image:
-        try:
-            image = None
-            image_camera = None
-            lidar = None
-            lidar_camera = None
-
-            for i in range(len(ego.cameras)):
-                img, sensor_name = sensor_queue.get(True, 2.0)
-                if sensor_name == 'sensor.camera.rgb':
-                    image = img
-                    image_camera = ego.cameras[i]
-                elif sensor_name == 'sensor.lidar.ray_cast':
-                    lidar = img
-                    lidar_camera = ego.cameras[i]
-                
-                if draw_bounding_box:
-                    # Only try to draw bb on separate screen if the cur image is the rgb image
-                    if sensor_name == 'sensor.camera.rgb' and ego.cameras[0].has_new_image:
-                        assert ego.cameras[0].blueprint == 'sensor.camera.rgb'
-                        camera = ego.cameras[0] # ! This should be the rgb camera, but is not guaranteed to be
-                        bb_img = bb.get_bb_img(world.world, ego.vehicle, img, camera)
-                        cv2.imwrite(os.path.join("test_bb", f"bb_img_{img.frame}.png"), bb_img)
-                        if debug:
-                            cv2.imshow('ImageWindowName',bb_img)
-
-                            if cv2.waitKey(10000) == ord('q'):
-                                break
-                            cv2.destroyAllWindows()
-            if image and lidar:
-                lidar_2d = project(image_data = image, lidar_data = lidar,
-                    camera = image_camera.camera, camera_bp = image_camera.camera_blueprint, 
-                    lidar = lidar_camera.camera, 
-                    camera_transform = image_camera.transform_at_last_image,
-                    lidar_transform = lidar_camera.transform_at_last_image)
-
-                lidar_out_dir = os.path.join(out_dir, image_camera.weathers[image_camera.counter // image_camera.num_images_per_weather], 'lidar_2d')
-                if not os.path.exists(lidar_out_dir):
-                    os.makedirs(lidar_out_dir)
-                np.save(os.path.join(lidar_out_dir, f"{image_camera.counter}.npy"), lidar_2d)
-
-            else:
-                print("    Some of the sensor information is missed")
-        except Empty:
-            print("    Some of the sensor information is missed")
-        ego.cameras[-1].has_new_image = False
-        # time.sleep(0.7)
\ No newline at end of file
+# Processes the frames the FrameSynchronizer (see frame_sync.py) has bundled up. Every rgb camera gets its boxes drawn
+# and written, and every lidar is projected onto every rgb camera. box_writer (a BoxAnnotationWriter) gets the boxes of
+# every rgb image if we have one. lidar_dense ('npz' or 'npy') also saves the lidar as dense depth/intensity images next
+# to lidar_2d (see dense_maps in lidar_projection.py). flush processes the frames that are still waiting for sensors.
+# profiler (a TickProfiler) gets the time of the lidar projection.
+# Returns True if q was pressed in the debug window, the frames we have are still processed but the run should stop.
+def check_has_image(ego: Ego_Vehicle, sensor_queue: FrameSynchronizer, world: World, debug: bool, draw_bounding_box: bool,
+                    out_dir: str, box_writer = None, lidar_dense: str = None, flush: bool = False,
+                    profiler: TickProfiler = None) -> bool:
+    if profiler is None:
+        profiler = TickProfiler()
+
+    quit_pressed = False
+
+    for bundle in sensor_queue.pop_ready(flush):
+        if not bundle.complete:
+            print(f"    Frame {bundle.frame} is missing {', '.join(bundle.missing)}")
+
+        images = bundle.by_blueprint('sensor.camera.rgb')
+        lidars = bundle.by_blueprint('sensor.lidar.ray_cast')
+        for image in images:
+            if draw_bounding_box:
+                bb_img = bb.get_bb_img(world.world, ego.vehicle, image.data, image.camera, image.vehicle_locations, image.transform)
+                cv2.imwrite(os.path.join("test_bb", f"bb_img_{image.camera.name}_{bundle.frame}.png"), bb_img)
+                if debug and not quit_pressed:
+                    cv2.imshow('ImageWindowName', bb_img)
+                    if cv2.waitKey(10000) == ord('q'):
+                        quit_pressed = True
+                    cv2.destroyAllWindows()
+
+            if box_writer is not None:
+                box_writer.add_frame(image, ego.vehicle.id)
+
+            for lidar in lidars:
+                camera = image.camera
+                with profiler.phase('lidar_projection'):
+                    lidar_2d = project(image_data = image.data, lidar_data = lidar.data,
+                        camera_calibration = camera.calibration,
+                        lidar_calibration = lidar.camera.calibration)
+
+                # the weather dir the image went to, and the image's counter so the two line up
+                weather_dir = os.path.dirname(os.path.dirname(image.path))
+                suffix = '' if camera.name == 'rgb' else f'_{camera.name}'
+                lidar_out_dir = os.path.join(weather_dir, f'lidar_2d{suffix}')
+                os.makedirs(lidar_out_dir, exist_ok=True)
+                np.save(os.path.join(lidar_out_dir, f"{image.counter}.npy"), lidar_2d)
+
+                if lidar_dense is not None:
+                    dense_out_dir = os.path.join(weather_dir, f'lidar_dense{suffix}')
+                    os.makedirs(dense_out_dir, exist_ok=True)
+                    depth, intensity = dense_maps(lidar_2d, camera.calibration.image_w, camera.calibration.image_h)
+                    save_dense_maps(os.path.join(dense_out_dir, f"{image.counter}"), depth, intensity, lidar_dense)
+    return quit_pressed
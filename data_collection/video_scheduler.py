@@ -0,0 +1,116 @@
+import time
+import carla
+from camera import Camera
+
+# In video mode most of the frames are thrown away (e.g. 18 saved, 40 waited), but the sensors still render them, send
+# them over and run the callback for every one of them. This puts the sensors to sleep (stops listening, so the server
+# stops producing their data) during the wait between videos and wakes them up again just before the next video.
+#
+# The camera counters have to keep the same meaning (they number the files, switch the weather, etc), so while a
+# camera sleeps we keep counting for it: we know which simulator frame it sent its last image on and how many frames
+# apart its images are, so every time the world gets past the frame where the next image would have come, we
+# increment its counter. wake_ahead is how many of the wait frames before a video we still actually receive, to give
+# the sensor some time to start sending again (and to check that the counter lines up, see Camera.listen).
+#
+# With fast_forward we also turn on no_rendering_mode while all the cameras sleep, so the simulator only runs the
+# physics/traffic for those ticks, and turn rendering back on render_ahead images before the cameras wake up. We keep
+# fixed_delta_seconds as it is so the traffic and walkers do exactly the same thing as without it for a given seed.
+# After every gap we print how much faster the gap went than it would have with rendering on.
+class VideoSensorScheduler():
+    def __init__(self, cameras: list, wake_ahead: int = 2, world: carla.World = None, fast_forward: bool = False,
+                 render_ahead: int = 1):
+        self.cameras = cameras
+        self.wake_ahead = wake_ahead
+        self.sleeps = 0
+
+        self.world = world
+        self.fast_forward = fast_forward
+        self.render_ahead = render_ahead
+        self.rendering = True
+
+        # Timing for the fast forward report
+        self.last_step_time = None
+        self.rendered_ticks = 0
+        self.rendered_seconds = 0.0
+        self.gap_ticks = 0
+        self.gap_seconds = 0.0
+        self.gaps = 0
+
+    def _wait_frames_left(self, camera: Camera) -> int:
+        # how many wait frames are left until the next video starts (or until the first video we save when resuming,
+        # resume_counter is always the start of a video)
+        if camera.counter < camera.resume_counter:
+            return camera.resume_counter - camera.counter
+        period = camera.video_images_wait + camera.video_images_saved
+        return period - camera.counter % period
+
+    # Call this after every world tick with the frame the tick returned
+    def step(self, frame: int):
+        now = time.perf_counter()
+        if self.last_step_time is not None:
+            if self.rendering:
+                self.rendered_ticks += 1
+                self.rendered_seconds += now - self.last_step_time
+            else:
+                self.gap_ticks += 1
+                self.gap_seconds += now - self.last_step_time
+        self.last_step_time = now
+
+        for camera in self.cameras:
+            if not camera.video_mode:
+                continue
+
+            wake = False
+            sleep = False
+            with camera.state_lock:
+                if camera.sleeping:
+                    while frame >= camera.next_frame:
+                        camera.increment()
+                        camera.next_frame += camera.frame_period
+
+                    if self._wait_frames_left(camera) <= self.wake_ahead:
+                        camera.sleeping = False
+                        wake = True
+                elif camera.frame_period and camera.is_wait_frame() and self._wait_frames_left(camera) > self.wake_ahead:
+                    camera.sleeping = True
+                    camera.next_frame = camera.last_frame + camera.frame_period
+                    sleep = True
+                    self.sleeps += 1
+
+            # talk to the server outside of the lock so we don't hold up the sensor callbacks
+            if wake:
+                camera.wake()
+            elif sleep:
+                camera.sleep()
+
+        if self.fast_forward:
+            self._update_rendering()
+
+    def _update_rendering(self):
+        video_cameras = [camera for camera in self.cameras if camera.video_mode]
+        if not video_cameras:
+            return
+
+        can_skip = all(camera.sleeping for camera in video_cameras) and \
+            min(self._wait_frames_left(camera) for camera in video_cameras) > self.wake_ahead + self.render_ahead
+
+        if can_skip and self.rendering:
+            self._set_rendering(False)
+        elif not can_skip and not self.rendering:
+            self._set_rendering(True)
+            self._report_gap()
+
+    def _set_rendering(self, rendering: bool):
+        settings = self.world.get_settings()
+        settings.no_rendering_mode = not rendering
+        self.world.apply_settings(settings)
+        self.rendering = rendering
+
+    def _report_gap(self):
+        self.gaps += 1
+        if self.gap_ticks > 0 and self.rendered_ticks > 0 and self.gap_seconds > 0:
+            rendered_estimate = self.gap_ticks * self.rendered_seconds / self.rendered_ticks
+            print(f"Fast forwarded gap {self.gaps}: {self.gap_ticks} ticks in {self.gap_seconds:.2f}s "
+                  f"instead of ~{rendered_estimate:.2f}s ({rendered_estimate / self.gap_seconds:.1f}x faster)")
+        self.gap_ticks = 0
+        self.gap_seconds = 0.0
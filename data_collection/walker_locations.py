@@ -0,0 +1,109 @@
+import os
+import re
+import tempfile
+import numpy as np
+
+# The walker spawn points for Town10HD live in town_10_HD_walker_locations.txt as one "Location(x=..., y=..., z=...)"
+# per line (see get_walker_locs.py). We used to open and regex the whole file every time we needed a location, now we
+# parse it once into an (N, 3) float array and keep a .npy copy next to the text file so later runs just load that.
+LOCATION_PATTERN = re.compile(r'[-+]?\d*\.\d+|\d+')
+
+def parse_walker_locations(path: str) -> np.ndarray:
+    locations = []
+    with open(path, 'r') as f:
+        for line in f:
+            loc = LOCATION_PATTERN.findall(line)
+            if len(loc) >= 3:
+                locations.append([float(loc[0]), float(loc[1]), float(loc[2])])
+    return np.array(locations, dtype=np.float64).reshape(-1, 3)
+
+def load_walker_locations(path: str) -> np.ndarray:
+    cache_path = os.path.splitext(path)[0] + '.npy'
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(path):
+        try:
+            locations = np.load(cache_path)
+            if locations.ndim == 2 and locations.shape[1] == 3:
+                return locations
+            print(f"{cache_path} has the wrong shape {locations.shape}, parsing {path} instead")
+        except (OSError, ValueError, EOFError) as e:
+            print(f"Could not load {cache_path} ({e}), parsing {path} instead")
+
+    locations = parse_walker_locations(path)
+    # Several runs can start at once (parallel_collection.py), so write to a temporary file and swap it in: the others
+    # see either no cache or the whole one, never half of it
+    temp_path = None
+    try:
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(cache_path)), suffix='.npy', delete=False) as f:
+            temp_path = f.name
+            np.save(f, locations)
+        # the temporary file is only readable by us
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, cache_path)
+    except OSError as e:
+        # not being able to write the cache is not a reason to stop
+        print(f"Could not cache the walker locations to {cache_path}: {e}")
+        if temp_path is not None and os.path.exists(temp_path):
+            os.remove(temp_path)
+    return locations
+
+# A simple uniform grid over the x/y plane so we can find the locations close to a point (e.g. the ego vehicle)
+# without computing the distance to every single location.
+class LocationGrid():
+    def __init__(self, locations: np.ndarray, cell_size: float = 20.0):
+        self.locations = locations
+        self.cell_size = cell_size
+
+        cells = np.floor(locations[:, :2] / cell_size).astype(np.int64)
+        self.cells = {}
+        for i, cell in enumerate(map(tuple, cells)):
+            self.cells.setdefault(cell, []).append(i)
+        self.cells = {cell: np.array(indices) for cell, indices in self.cells.items()}
+
+    # Indices of the locations within max_distance (in x/y) of center
+    def query(self, center, max_distance: float) -> np.ndarray:
+        min_cell = np.floor((np.asarray(center[:2]) - max_distance) / self.cell_size).astype(np.int64)
+        max_cell = np.floor((np.asarray(center[:2]) + max_distance) / self.cell_size).astype(np.int64)
+
+        candidates = [self.cells[(cx, cy)]
+                      for cx in range(min_cell[0], max_cell[0] + 1)
+                      for cy in range(min_cell[1], max_cell[1] + 1)
+                      if (cx, cy) in self.cells]
+        if not candidates:
+            return np.zeros(0, dtype=np.int64)
+
+        candidates = np.concatenate(candidates)
+        distances = np.linalg.norm(self.locations[candidates, :2] - np.asarray(center[:2]), axis=1)
+        return candidates[distances <= max_distance]
+
+class WalkerLocations():
+    def __init__(self, path: str, rng = np.random, use_grid: bool = False):
+        self.locations = load_walker_locations(path)
+        # rng defaults to numpy's global generator, which World seeds with the random seed. Drawing from the same
+        # generator as before keeps the walkers of a seed the same as in the datasets we already collected.
+        self.rng = rng
+        self.grid = LocationGrid(self.locations) if use_grid else None
+
+    def __len__(self):
+        return len(self.locations)
+
+    # Returns an (x, y, z) row, or None if no location fits. near is an (x, y) or (x, y, z) point, the distances to it
+    # are measured in the x/y plane.
+    def sample(self, near = None, min_distance: float = 0.0, max_distance: float = None):
+        if near is None or (min_distance <= 0 and max_distance is None):
+            return self.locations[self.rng.choice(len(self.locations))]
+
+        near = np.asarray(near, dtype=np.float64)
+        if max_distance is not None and self.grid is not None:
+            candidates = self.grid.query(near, max_distance)
+        else:
+            candidates = np.arange(len(self.locations))
+
+        distances = np.linalg.norm(self.locations[candidates, :2] - near[:2], axis=1)
+        keep = distances >= min_distance
+        if max_distance is not None:
+            keep &= distances <= max_distance
+        candidates = candidates[keep]
+
+        if len(candidates) == 0:
+            return None
+        return self.locations[self.rng.choice(candidates)]
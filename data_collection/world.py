@@ -2,25 +2,34 @@ import carla
 import yaml
 import random
 import logging
+import time
 import numpy as np
 from weather import Weather
-import re
+from walker_locations import WalkerLocations
+from blueprint_cache import BlueprintCache
+import os
 
 # In general, I think the organization of this file is a bit off. Really, it shouldn't be called utilities.py
 # and the methods I have chosen to wrap/not wrap in the world wrapper class are a bit arbitrary. I think we should
 # refactor this to be more consistent and organized.
 
 class World():
-    def __init__(self, host: str, port: int, synchronous: bool = True, 
-                 max_num_vehicles: int = 50, max_num_walkers: int = 100, random_seed: int = None):
+    def __init__(self, host: str, port: int, synchronous: bool = True, tm_port: int = 8000,
+                 max_num_vehicles: int = 50, max_num_walkers: int = 100, random_seed: int = None,
+                 walker_location_grid: bool = False, warm_reset: bool = False):
         # Create client and connect to server (the simulator)
-        self.client = carla.Client('localhost', 2000)
+        self.client = carla.Client(host, port)
         self.client.set_timeout(10.0)
 
         # Retrieve the world that is running
         # self.world = self.client.load_world('Town02_Opt')
-        self.world = self.client.load_world('Town10HD')
+        # With warm_reset we reuse the server from the last run: if it already has Town10HD loaded we only clear out
+        # what the last run left behind (see reset) instead of loading the map again.
         self.world = self.client.get_world()
+        reuse_map = warm_reset and self.world.get_map().name.split('/')[-1] == 'Town10HD'
+        if not reuse_map:
+            self.world = self.client.load_world('Town10HD')
+            self.world = self.client.get_world()
         
         self.original_settings = self.world.get_settings()
         self.settings = self.world.get_settings()
@@ -28,10 +37,14 @@ class World():
         # Set CARLA syncronous mode
         self.settings.synchronous_mode = True
         self.settings.fixed_delta_seconds = 0.05
+        self.settings.no_rendering_mode = False
         self.world.apply_settings(self.settings)
 
+        if reuse_map:
+            self.reset()
+
         # Traffic manager
-        self.traffic_manager = self.client.get_trafficmanager()
+        self.traffic_manager = self.client.get_trafficmanager(tm_port)
         self.traffic_manager.set_synchronous_mode(True)
         if random_seed is not None:
             self.traffic_manager.set_random_device_seed(random_seed)
@@ -40,16 +53,52 @@ class World():
         self.walkers = []
         self.vehicles = []
 
+        # Fetched once, see blueprint_cache.py. filter arguments of the spawn functions can also be pool names
+        self.blueprints = BlueprintCache(self.world, rng = np.random)
+
         self.max_num_vehicles = max_num_vehicles
         self.max_num_walkers = max_num_walkers
 
-    # !!! Evil hardcoded values !!!
-    def get_random_walker_location(self):
-        with open('town_10_HD_walker_locations.txt', 'r') as f:
-            lines = f.readlines()
-            loc = np.random.choice(lines)
-            loc = re.findall(r'[-+]?\d*\.\d+|\d+', loc)
-            return carla.Location(x=float(loc[0]), y=float(loc[1]), z=float(loc[2]))
+        # !!! Evil hardcoded values !!!
+        # Parsed once here (and cached as a .npy next to the text file), sampled with the seeded numpy generator.
+        # walker_location_grid builds a grid over the locations for the near/min_distance/max_distance queries.
+        self.walker_locations = WalkerLocations(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'town_10_HD_walker_locations.txt'),
+                                                rng = np.random, use_grid = walker_location_grid)
+
+    # Get a world another run used back to how load_world leaves it: all the vehicles, walkers, controllers and sensors
+    # are destroyed in one batch and the traffic lights are reset. If something survives that (e.g. the last run
+    # crashed in the middle of spawning) we fall back to reload_world, keeping the settings we just applied.
+    # A warm reset world is not identical to a freshly loaded one, so a seed won't reproduce a cold start run exactly.
+    def reset(self):
+        start = time.perf_counter()
+        leftovers = self._leftover_actors()
+        # controllers first so they don't try to move walkers that are already gone
+        leftovers.sort(key = lambda actor: not actor.type_id.startswith('controller.'))
+        if leftovers:
+            self.client.apply_batch_sync([carla.command.DestroyActor(actor) for actor in leftovers], True)
+
+        if self._leftover_actors():
+            print("Actors left over after the reset, reloading the world")
+            self.world = self.client.reload_world(reset_settings = False)
+        else:
+            self.world.reset_all_traffic_lights()
+            self.world.tick()
+
+        print(f"Warm reset destroyed {len(leftovers)} actors in {time.perf_counter() - start:.2f}s")
+
+    def _leftover_actors(self):
+        return [actor for actor in self.world.get_actors()
+                if actor.type_id.startswith(('vehicle.', 'walker.', 'controller.', 'sensor.'))]
+
+    # near (a carla.Location, e.g. the ego vehicle's) with min_distance and/or max_distance restricts the locations to
+    # the ones at least min_distance and at most max_distance away from it. Returns None if there is no such location.
+    def get_random_walker_location(self, near: carla.Location = None, min_distance: float = 0.0, max_distance: float = None):
+        if near is not None:
+            near = (near.x, near.y, near.z)
+        loc = self.walker_locations.sample(near, min_distance, max_distance)
+        if loc is None:
+            return None
+        return carla.Location(x=float(loc[0]), y=float(loc[1]), z=float(loc[2]))
 
     # Fix this organization -> decide whether Weather or world should hold the weather object
     def load_weathers(self, configs: str):
@@ -66,51 +115,89 @@ class World():
         return self.world.get_map().get_spawn_points()
     
     def get_blueprints(self, filter: str):
-        return self.world.get_blueprint_library().filter(filter)
+        return self.blueprints.filter(filter)
     
-    def spawn_car(self, filter = 'vehicle.*.*', number = 1):
+    # batch spawns all the cars in one apply_batch_sync round trip (SpawnActor + SetAutopilot per car) on distinct spawn
+    # points. The default (batch = False) is the old one by one spawning, which picks spawn points with replacement and
+    # so wastes attempts on collisions, but draws the same random numbers as before so it reproduces our older datasets
+    # for a seed. Batch spawning gives a seed different traffic.
+    def spawn_car(self, filter = 'vehicle.*.*', number = 1, batch = False):
         if len(self.vehicles) > self.max_num_vehicles:
             # raise Exception('Max number of vehicles reached')
             print('Max number of vehicles reached')
 
+        start = time.perf_counter()
         spawn_points = self.get_spawn_points()
 
-        max_vehicles = 30
-        max_vehicles = min([max_vehicles, len(spawn_points)])
-        new_vehicles = []
+        if batch:
+            new_vehicles = self._spawn_cars_batch(filter, spawn_points, number)
+        else:
+            new_vehicles = self._spawn_cars_one_by_one(filter, spawn_points, number)
+        successfully_spawned = len(new_vehicles)
+
+        # The traffic manager only has per vehicle setters for these (no batch command or global version). It runs in
+        # this process (get_trafficmanager starts it here unless another client already runs one on tm_port), so they
+        # are local calls and not a round trip to the server each.
+        for v in new_vehicles:
+            self.traffic_manager.random_left_lanechange_percentage(v, 0)
+            self.traffic_manager.random_right_lanechange_percentage(v, 0)
+            self.traffic_manager.auto_lane_change(v, True)  
+        self.traffic_manager.set_synchronous_mode(True)
         
-        successfully_spawned = 0
+        self.vehicles.extend(new_vehicles)
+
+        print(f"Spawning {successfully_spawned} cars took {time.perf_counter() - start:.2f}s")
+
+        return successfully_spawned
+
+    def _spawn_cars_batch(self, filter, spawn_points, number):
+        if number > len(spawn_points):
+            print(f'Only {len(spawn_points)} spawn points for {number} cars')
+            number = len(spawn_points)
+
+        tm_port = self.traffic_manager.get_port()
+        batch = []
+        for i in np.random.choice(len(spawn_points), number, replace=False):
+            blueprint = self.blueprints.sample(filter)
+            batch.append(carla.command.SpawnActor(blueprint, spawn_points[i])
+                         .then(carla.command.SetAutopilot(carla.command.FutureActor, True, tm_port)))
+
+        vehicle_ids = []
+        for result in self.client.apply_batch_sync(batch, True):
+            if result.error:
+                logging.error(result.error)
+            else:
+                vehicle_ids.append(result.actor_id)
+
+        return list(self.world.get_actors(vehicle_ids))
+
+    def _spawn_cars_one_by_one(self, filter, spawn_points, number):
+        new_vehicles = []
         for i in range(number):
-            blueprint = np.random.choice(self.world.get_blueprint_library().filter(filter))
+            blueprint = self.blueprints.sample(filter)
             spawn_point = np.random.choice(spawn_points)
             vehicle = self.world.try_spawn_actor(blueprint, spawn_point)
             if vehicle is not None:
                 new_vehicles.append(vehicle)
-                successfully_spawned += 1
             else:
                 # print('Could not spawn vehicle')
                 pass
 
         for v in new_vehicles:
-            v.set_autopilot(True) 
-            self.traffic_manager.random_left_lanechange_percentage(v, 0)
-            self.traffic_manager.random_right_lanechange_percentage(v, 0)
-            self.traffic_manager.auto_lane_change(v, True)  
-            self.traffic_manager.set_synchronous_mode(True)
-        
-        self.vehicles.extend(new_vehicles)
+            v.set_autopilot(True, self.traffic_manager.get_port()) 
 
-        return successfully_spawned
+        return new_vehicles
 
-        
-    def spawn_walker(self, filter = 'walker.pedestrian.*', number = 1):
+    # near/min_distance/max_distance are passed on to get_random_walker_location for the spawn points
+    def spawn_walker(self, filter = 'walker.pedestrian.*', number = 1, near: carla.Location = None, min_distance: float = 0.0,
+                     max_distance: float = None):
         if len(self.walkers) > self.max_num_walkers:
             raise Exception('Max number of walkers reached')
         
         spawn_points = []
         for i in range(number):
             spawn_point = carla.Transform()
-            loc = self.get_random_walker_location()
+            loc = self.get_random_walker_location(near, min_distance, max_distance)
             if (loc != None):
                 spawn_point.location = loc
                 spawn_points.append(spawn_point)
@@ -118,15 +205,15 @@ class World():
         new_walkers = []
         
         # Select some models from the blueprint library
-        blueprint = np.random.choice(self.world.get_blueprint_library().filter(filter))
+        blueprint = self.blueprints.sample(filter)
         if blueprint.has_attribute('is_invincible'):
             blueprint.set_attribute('is_invincible', 'false')
 
         successfully_spawned = 0
         for i in range(number):
-            blueprint = np.random.choice(self.world.get_blueprint_library().filter(filter))
+            blueprint = self.blueprints.sample(filter)
             spawn_point = carla.Transform()
-            loc = self.get_random_walker_location()
+            loc = self.get_random_walker_location(near, min_distance, max_distance)
             if (loc != None):
                 spawn_point.location = loc
             else:
@@ -142,7 +229,7 @@ class World():
                 pass
         
         batch = []
-        walker_controller_bp = self.world.get_blueprint_library().find('controller.ai.walker')
+        walker_controller_bp = self.blueprints.find('controller.ai.walker')
         for i in range(len(new_walkers)):
             batch.append(carla.command.SpawnActor(walker_controller_bp, carla.Transform(), new_walkers[i]))
         results = self.client.apply_batch_sync(batch, True)
@@ -159,25 +246,93 @@ class World():
 
         return successfully_spawned
 
-    def replace_dead_walkers(self):
-        death_count = 0
-        respawn_count = 0
+    # Spawns number walkers with their controllers in two batches (walkers, then controllers) instead of one
+    # try_spawn_actor per walker. Returns the number of walkers that made it.
+    # Neither batch ticks the world (do_tick = False): this runs from check_dead in the middle of the main loop, and a
+    # tick here would be a frame the cameras, the scheduler, the FrameSynchronizer and the profiler never hear about.
+    # The actors exist on the server as soon as the batch returns, so the controllers can attach to the walkers right
+    # away.
+    def _spawn_walkers_batch(self, number, filter = 'walker.pedestrian.*'):
+        batch = []
+        for i in range(number):
+            loc = self.get_random_walker_location()
+            blueprint = self.blueprints.sample(filter)
+            if blueprint.has_attribute('is_invincible'):
+                blueprint.set_attribute('is_invincible', 'false')
+            batch.append(carla.command.SpawnActor(blueprint, carla.Transform(loc, carla.Rotation())))
+
+        walker_ids = []
+        for result in self.client.apply_batch_sync(batch, False):
+            if result.error:
+                logging.error(result.error)
+            else:
+                walker_ids.append(result.actor_id)
+
+        walker_controller_bp = self.blueprints.find('controller.ai.walker')
+        batch = [carla.command.SpawnActor(walker_controller_bp, carla.Transform(), walker_id) for walker_id in walker_ids]
+
+        pairs = []
+        orphans = []
+        for walker_id, result in zip(walker_ids, self.client.apply_batch_sync(batch, False)):
+            if result.error:
+                logging.error(result.error)
+                orphans.append(carla.command.DestroyActor(walker_id))
+            else:
+                pairs.append((walker_id, result.actor_id))
+        if orphans:
+            self.client.apply_batch(orphans)
+
+        actors = {actor.id: actor for actor in self.world.get_actors([id for pair in pairs for id in pair])}
+        for walker_id, controller_id in pairs:
+            controller = actors[controller_id]
+            controller.start()
+            controller.go_to_location(self.get_random_walker_location())
+            controller.set_max_speed(np.random.uniform(1.0, 3.0))  # Random speeds
+            self.walkers.append((actors[walker_id], controller))
+
+        return len(pairs)
+
+    # Finds all the dead walkers in one pass, destroys them (and their controllers) in one batch and spawns the
+    # replacements in batches, retrying the ones that fail to spawn up to max_attempts times.
+    # (This used to remove from self.walkers while looping over it, which skipped the walker after every dead one.)
+    def replace_dead_walkers(self, max_attempts = 10):
+        start = time.perf_counter()
 
+        alive = []
+        dead = []
         for walker, controller in self.walkers:
-            if walker.is_active == False:
-                death_count += 1
-                self.client.apply_batch([carla.command.DestroyActor(walker)])
-                self.client.apply_batch([carla.command.DestroyActor(controller)])
-                self.walkers.remove((walker, controller))
-                successfully_spawned = 0
-
-                attempts = 0
-                while successfully_spawned == 0 and attempts < 10:
-                    successfully_spawned = self.spawn_walker()
-                    attempts += 1
-                respawn_count += 1
-        
+            if walker.is_active:
+                alive.append((walker, controller))
+            else:
+                dead.append((walker, controller))
+        death_count = len(dead)
+
+        if dead:
+            batch = []
+            for walker, controller in dead:
+                batch.append(carla.command.DestroyActor(controller))
+                batch.append(carla.command.DestroyActor(walker))
+            self.client.apply_batch(batch)
+        self.walkers = alive
+        destroy_time = time.perf_counter() - start
+
+        respawn_count = 0
+        attempts = 0
+        while respawn_count < death_count and attempts < max_attempts:
+            respawn_count += self._spawn_walkers_batch(death_count - respawn_count)
+            attempts += 1
+        total_time = time.perf_counter() - start
+
         print(f"{death_count} dead walkers replaced with {respawn_count} new walkers")
+
+        return {
+            'dead': death_count,
+            'respawned': respawn_count,
+            'attempts': attempts,
+            'destroy_seconds': destroy_time,
+            'spawn_seconds': total_time - destroy_time,
+            'total_seconds': total_time,
+        }
     
     def clean_up(self):
         self.world.apply_settings(self.original_settings)
@@ -11,8 +11,51 @@ from pycocotools import mask
 import shutil
 import random
 import math
+import argparse
+import multiprocessing
+import gzip
+from data_collection.categories import category_dict
 
 def create_sub_masks(mask_image, width, height):
+    # Vectorized version of create_sub_masks_pixelwise below. We load the image once as an array,
+    # pack the rgb of every actor pixel into one integer key and group the pixels by key with np.unique.
+    # The output is the same dict of padded masks (as boolean arrays), in the same order the per pixel
+    # loop would have created them, so annotation and instance ids don't change.
+    pixels = np.asarray(mask_image, dtype=np.uint8)[:height, :width, :3]
+
+    # walk the image column by column (x then y) like the old loop so the first occurrences line up
+    pixels = pixels.transpose(1, 0, 2).reshape(-1, 3)
+    actor_pixels = np.nonzero((pixels[:, 0] >= 12) & (pixels[:, 0] <= 19))[0]
+
+    sub_masks = {}
+    if actor_pixels.size == 0:
+        return sub_masks
+
+    actor_rgb = pixels[actor_pixels].astype(np.uint32)
+    packed = (actor_rgb[:, 0] << 16) | (actor_rgb[:, 1] << 8) | actor_rgb[:, 2]
+    keys, first_seen, inverse = np.unique(packed, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+
+    # split the pixel positions into one group per instance
+    grouped = actor_pixels[np.argsort(inverse, kind='stable')]
+    groups = np.split(grouped, np.cumsum(np.bincount(inverse, minlength=len(keys)))[:-1])
+
+    for k in np.argsort(first_seen):
+        key = int(keys[k])
+        pixel_str = str((key >> 16, (key >> 8) & 255, key & 255))
+
+        xs, ys = np.divmod(groups[k], height)
+
+        # Note: we still add 1 pixel of padding in each direction for the contours module
+        sub_mask = np.zeros((height+2, width+2), dtype=bool)
+        sub_mask[ys+1, xs+1] = True
+        sub_masks[pixel_str] = sub_mask
+
+    return sub_masks
+
+# The original per pixel implementation. This is really slow (~2M getpixel calls for a 1920x1080 frame),
+# we only keep it around to check the vectorized version against it (see benchmark_sub_masks.py)
+def create_sub_masks_pixelwise(mask_image, width, height):
     # Initialize a dictionary of sub-masks indexed by RGB colors
     sub_masks = {}
     for x in range(width):
@@ -67,11 +110,34 @@ def create_sub_mask_annotation(sub_mask):
         # segmentation = np.array(poly.exterior.coords).ravel().tolist()
         # segmentations.append(segmentation)
 
-    segmentation = mask.encode(np.asfortranarray(sub_mask))
-    segmentation["counts"] = segmentation["counts"] # .decode("utf-8")
+    segmentation = create_sub_mask_rle(sub_mask)
     
     return polygons, segmentation
 
+def create_sub_mask_rle(sub_mask):
+    segmentation = mask.encode(np.asfortranarray(sub_mask))
+    segmentation["counts"] = segmentation["counts"] # .decode("utf-8")
+    return segmentation
+
+def create_sub_mask_bbox(sub_mask):
+    # Fast path for when we only need the bbox and area: read them straight off the mask instead of going
+    # through find_contours and shapely. The bbox is in pixels (x, y, width, height) with the padding removed
+    # and the area is the number of pixels in the mask. Returns None, 0 for an empty mask.
+    rows = np.nonzero(np.any(sub_mask, axis=1))[0]
+    cols = np.nonzero(np.any(sub_mask, axis=0))[0]
+    if rows.size == 0:
+        return None, 0
+
+    # subtract the padding pixel
+    min_x = int(cols[0]) - 1
+    min_y = int(rows[0]) - 1
+    width = int(cols[-1] - cols[0]) + 1
+    height = int(rows[-1] - rows[0]) + 1
+    bbox = (min_x, min_y, width, height)
+    area = int(np.count_nonzero(sub_mask))
+
+    return bbox, area
+
 def create_category_annotation(category_dict):
     category_list = []
 
@@ -119,6 +185,9 @@ def create_annotation_format(polygon, segmentation, image_id, category_id, annot
     bbox = (min_x, min_y, width, height)
     area = polygon.area
 
+    return create_annotation(bbox, area, segmentation, image_id, category_id, annotation_id, video_id, instance_id)
+
+def create_annotation(bbox, area, segmentation, image_id, category_id, annotation_id, video_id, instance_id):
     annotation = {
         "id": annotation_id,
         "video_id": video_id,
@@ -144,7 +213,173 @@ def get_coco_json_format():
 
     return coco_format
 
-def generate_vis_annotations(path_to_weather_types):
+def _json_default(obj):
+    # pycocotools gives us the rle counts as bytes, which json can't write
+    if isinstance(obj, bytes):
+        return obj.decode("utf-8")
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+class AnnotationWriter():
+    # Writes the same json as get_coco_json_format + json.dump, but streams the images and annotations to disk as
+    # they are added instead of keeping the whole dataset in memory. The images go straight into the output file and
+    # the annotations go into a temporary file next to it, which gets copied in after the images when we close.
+    # By default the output is formatted like json.dump(..., indent=4). compact drops all of the whitespace and
+    # use_gzip writes a gzipped file (.gz gets added to the path if it isn't there).
+    def __init__(self, json_path, categories, videos, compact = False, use_gzip = False):
+        if use_gzip and not json_path.endswith('.gz'):
+            json_path = json_path + '.gz'
+        self.json_path = json_path
+        self.compact = compact
+        self.use_gzip = use_gzip
+
+        self.num_images = 0
+        self.num_annotations = 0
+
+        self.file = self._open(json_path)
+        self.annotation_path = json_path + '.annotations.tmp'
+        self.annotation_file = open(self.annotation_path, 'w')
+
+        self.file.write('{')
+        self._write_array(self.file, 'categories', categories, first_key = True)
+        self._write_array(self.file, 'videos', videos)
+        self._write_key(self.file, 'images')
+
+    def _open(self, path):
+        if self.use_gzip:
+            return gzip.open(path, 'wt', encoding='utf-8')
+        return open(path, 'w')
+
+    def _dumps(self, item):
+        if self.compact:
+            return json.dumps(item, separators=(',', ':'), default=_json_default)
+        # every item sits two levels deep in the indent=4 layout
+        return json.dumps(item, indent=4, default=_json_default).replace('\n', '\n        ')
+
+    def _write_key(self, file, key, first_key = False):
+        if self.compact:
+            file.write(('' if first_key else ',') + f'"{key}":[')
+        else:
+            file.write(('' if first_key else ',') + f'\n    "{key}": [')
+
+    def _write_item(self, file, item, first_item):
+        if self.compact:
+            file.write(('' if first_item else ',') + self._dumps(item))
+        else:
+            file.write(('' if first_item else ',') + '\n        ' + self._dumps(item))
+
+    def _end_array(self, file, num_items):
+        if self.compact or num_items == 0:
+            file.write(']')
+        else:
+            file.write('\n    ]')
+
+    def _write_array(self, file, key, items, first_key = False):
+        self._write_key(file, key, first_key)
+        for i in range(len(items)):
+            self._write_item(file, items[i], i == 0)
+        self._end_array(file, len(items))
+
+    def add_image(self, image):
+        self._write_item(self.file, image, self.num_images == 0)
+        self.num_images += 1
+
+    def add_annotation(self, annotation):
+        self._write_item(self.annotation_file, annotation, self.num_annotations == 0)
+        self.num_annotations += 1
+
+    def close(self):
+        self._end_array(self.file, self.num_images)
+
+        self._write_key(self.file, 'annotations')
+        self.annotation_file.close()
+        with open(self.annotation_path, 'r') as annotation_file:
+            shutil.copyfileobj(annotation_file, self.file)
+        os.remove(self.annotation_path)
+        self._end_array(self.file, self.num_annotations)
+
+        self.file.write('}' if self.compact else '\n}')
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def generate_video_annotations(image_path, video_name, video_id, use_polygons = False):
+    # Generate the image and annotation entries for a single video. This is the unit of work we hand out to the
+    # worker processes, so it can't touch anything shared: the annotation ids are left as None and get filled in
+    # by generate_vis_annotations when it merges the videos back together in order. Instance ids are per video
+    # so we can assign those in here.
+
+    # By default the bbox and area come straight from the mask (create_sub_mask_bbox). The contour/shapely polygon
+    # path is only used with use_polygons, it is much slower and we only save the rle as the segmentation anyway.
+    instances = {}
+    inst_id = 1
+
+    #get a list of all the image/frames of a video
+    images = os.listdir(image_path)
+
+    image_list = []
+    annotation_list = []
+
+    for j in range(len(images)):
+        image_id = video_id * 100000 + (j+1)
+        frame = os.path.join(image_path, images[j])
+        img = Image.open(frame)
+
+        #add image information to the dictionary
+        image_list.append(create_image_annotation(os.path.join(video_name,images[j]),img.width, img.height, image_id, j, video_id))
+
+        sub_masks = create_sub_masks(img, img.width, img.height)
+
+        for k,v in sub_masks.items():
+            if use_polygons:
+                polygons, segmentation = create_sub_mask_annotation(v)
+
+                if polygons == []:
+                    continue
+
+                if len(polygons) > 1:
+                    # print(f"polygons: {polygons}")
+                    # print(f"Types in polygons: {[type(p) for p in polygons]}")
+
+                    polygon = MultiPolygon(polygons)
+                    # segmentation = segmentations
+                else:
+                    polygon = polygons[0]
+                    # segmentation = [np.array(polygons[0].exterior.coords).ravel().tolist()] ##i forgot what this id donig
+            else:
+                bbox, area = create_sub_mask_bbox(v)
+
+                if bbox is None:
+                    continue
+
+                segmentation = create_sub_mask_rle(v)
+
+            cur_instance = "-".join(k.split()[1:])
+
+            if cur_instance in instances:
+                instance_id = instances[cur_instance]
+            else:
+                instances[cur_instance] = inst_id
+                instance_id = inst_id
+                inst_id += 1
+
+            if use_polygons:
+                # polygon, segmentation, image_id, category_id, annotation_id, video_id, instance_id, im_height, im_width
+                annotation = create_annotation_format(polygon, segmentation, image_id, int(k[1:3]), None, video_id, instance_id, img.height, img.width)
+            else:
+                annotation = create_annotation(bbox, area, segmentation, image_id, int(k[1:3]), None, video_id, instance_id)
+            annotation_list.append(annotation)
+
+    return image_list, annotation_list
+
+def _generate_video_annotations_job(job):
+    # Pool.imap only passes a single argument
+    return generate_video_annotations(*job)
+
+def generate_vis_annotations(path_to_weather_types, workers = 1, compact = False, use_gzip = False, use_polygons = False):
     #we want this fuinction to go through each, weather, each video, and each image 
     # to generate the correstponding annotations which it will dump in a json file at the end
 
@@ -154,90 +389,60 @@ def generate_vis_annotations(path_to_weather_types):
     # for each folder go through all of the images
     # fr each image add to images then go through the pixels to generate annotations for seg mask
 
+    # With workers > 1 the videos are handed out to a process pool. imap gives the results back in the same order
+    # as the serial loop and the annotation ids are only assigned here, so the json is identical to a serial run.
+
+    # The images and annotations are streamed to annotations.json through AnnotationWriter as each video finishes,
+    # so memory doesn't grow with the size of the dataset. compact and use_gzip are passed on to the writer.
+
     print('Generating annotations...\n\n')
 
     weathers = os.listdir(path_to_weather_types)
     splits = ['train', 'val']
     annotation_id = 1
 
-    for weather in weathers:
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
 
-        for split in splits:
-
-            ann = get_coco_json_format()
-
-            category_dict = {
-                'pedestrian' : 12,
-                'rider' : 13,
-                'car' : 14,
-                'truck' : 15,
-                'bus' : 16,
-                'train': 17,
-                'motorcycle' : 18,
-                'bicycle' : 19
-            }
-
-            ann['categories'] = create_category_annotation(category_dict)
-
-            # get all videos from within the weather dir
-            weather_path = os.path.join(path_to_weather_types, weather, split,  'instance_seg')
-            videos = os.listdir(weather_path)
-
-            for i in range(len(videos)):
-                instances = {}
-                inst_id = 1
-                video_id = i+1
-                #get a list of all the image/frames of a video
-                image_path = os.path.join(weather_path, videos[i])
-                images = os.listdir(image_path)
-
-                #this funcitons assumes standard image  sizes set in the earlier code of 1920x1080
-                ann['videos'].append(create_video_annotation(video_id, videos[i]))
-
-                for j in range(len(images)):
-                    image_id = video_id * 100000 + (j+1)
-                    frame = os.path.join(image_path, images[j])
-                    img = Image.open(frame)
-
-                    #add image information to the dictionary
-                    ann['images'].append(create_image_annotation(os.path.join(videos[i],images[j]),img.width, img.height, image_id, j, video_id))
-
-                    sub_masks = create_sub_masks(img, img.width, img.height)
-
-                    for k,v in sub_masks.items():
-                        polygons, segmentation = create_sub_mask_annotation(v)
-
-                        if polygons != []:
-                            if len(polygons) > 1:
-                                # print(f"polygons: {polygons}")
-                                # print(f"Types in polygons: {[type(p) for p in polygons]}")
-
-                                polygon = MultiPolygon(polygons)
-                                # segmentation = segmentations
-                            else:
-                                polygon = polygons[0]
-                                # segmentation = [np.array(polygons[0].exterior.coords).ravel().tolist()] ##i forgot what this id donig
-
-                            cur_instance = "-".join(k.split()[1:])
-
-                            if cur_instance in instances:
-                                instance_id = instances[cur_instance]
-                            else:
-                                instances[cur_instance] = inst_id
-                                instance_id = inst_id
-                                inst_id += 1
-
-                            # polygon, segmentation, image_id, category_id, annotation_id, video_id, instance_id, im_height, im_width
-                            annotation = create_annotation_format(polygon, segmentation, image_id, int(k[1:3]), annotation_id, video_id, instance_id, img.height, img.width)
-                            ann['annotations'].append(annotation)
-                            annotation_id += 1
+    try:
+        for weather in weathers:
 
-            
-            #dump the annotations for each weather pattern in a json dictionary
-            json_path = os.path.join(path_to_weather_types, weather, split, 'annotations.json')
+            for split in splits:
 
-            with open(json_path, "w") as file:
-                json.dump(ann, file, indent=4)
+                categories = create_category_annotation(category_dict)
+
+                # get all videos from within the weather dir
+                weather_path = os.path.join(path_to_weather_types, weather, split,  'instance_seg')
+                videos = os.listdir(weather_path)
+
+                video_list = []
+                jobs = []
+                for i in range(len(videos)):
+                    video_id = i+1
+                    #this funcitons assumes standard image  sizes set in the earlier code of 1920x1080
+                    video_list.append(create_video_annotation(video_id, videos[i]))
+                    jobs.append((os.path.join(weather_path, videos[i]), videos[i], video_id, use_polygons))
+
+                if pool is not None:
+                    results = pool.imap(_generate_video_annotations_job, jobs)
+                else:
+                    results = map(_generate_video_annotations_job, jobs)
+
+                #dump the annotations for each weather pattern in a json file as we go
+                json_path = os.path.join(path_to_weather_types, weather, split, 'annotations.json')
+
+                with AnnotationWriter(json_path, categories, video_list, compact = compact, use_gzip = use_gzip) as writer:
+                    for image_list, annotation_list in results:
+                        for image in image_list:
+                            writer.add_image(image)
+
+                        for annotation in annotation_list:
+                            annotation['id'] = annotation_id
+                            writer.add_annotation(annotation)
+                            annotation_id += 1
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
     print('\n\nFinished generating annotations!')
 
@@ -432,7 +637,15 @@ def split_train_val(path_to_weathers):
                 
 
 if __name__ == '__main__':
-    path = '/Data/video_data'
+    parser = argparse.ArgumentParser(description='Generate VIS annotations')
+    parser.add_argument('--path', type=str, default='/Data/video_data', help='Folder with the weather folders')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes to generate annotations with')
+    parser.add_argument('--compact', action='store_true', help='Write the annotations without indentation')
+    parser.add_argument('--gzip', action='store_true', help='Gzip the annotation files')
+    parser.add_argument('--polygons', action='store_true', help='Compute the bbox and area from simplified polygons instead of the masks (slow)')
+    args = parser.parse_args()
+
+    path = args.path
 
     path_test = '/Data/masaddee/data_trial/0126-172926'
 
@@ -442,4 +655,4 @@ if __name__ == '__main__':
     enforce_video_organization(path)
 
     #generate annotations
-    generate_vis_annotations(path)
\ No newline at end of file
+    generate_vis_annotations(path, workers = args.workers, compact = args.compact, use_gzip = args.gzip, use_polygons = args.polygons)
\ No newline at end of file